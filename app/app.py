@@ -1,63 +1,153 @@
 # Standard library imports
 import os
+import json
+import html
+import base64
+import time
+import queue
+import atexit
 import logging
 import threading
-
-# Flask, Google Oauth, and third-party imports
-from flask import Flask, session, url_for, render_template, request, redirect, jsonify, abort
-from authlib.integrations.flask_client import OAuth
-from authlib.common.security import generate_token
-import keyring
-from dotenv import load_dotenv
-import validators
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-# Selenium imports
-from selenium import webdriver
-from selenium.webdriver.firefox.options import Options
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.by import By
+# Get the absolute path of the current file (main.py)
+current_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Go up one level to the project root
+project_root = os.path.dirname(current_dir)
+
+# Environment variables are loaded before the local modules below read their configuration
+# python-dotenv is only imported when there is a .env file to load
+if os.path.exists(os.path.join(project_root, '.env')):
+    from dotenv import load_dotenv
+    load_dotenv(os.path.join(project_root, '.env'))
+
+# Flask and third-party imports
+# Selenium, authlib and keyring are imported on first use so that starting a worker doesn't load them
+from flask import Blueprint, Flask, Response, current_app, g, session, url_for, render_template, request, redirect, jsonify, abort, make_response
+import validators
 
 # Local imports
 from database import (
     add_database_novel,
     delete_database_novels,
     get_all_database_novels,
-    get_chapter_title_and_number,
-    get_chapter_numbers,
-    get_preload_urls,
-    get_chapter_content,
+    get_library_page,
+    get_reader_state,
+    get_stored_chapter,
+    get_stored_chapter_numbers,
+    iter_stored_chapters,
+    start_prefetch_job,
+    finish_prefetch_job,
+    get_prefetch_progress,
     update_chapter_content,
-    move_chapter,
-    update_read_history,
+    ReaderUpdate,
+    reader_updates,
+    close_connection,
+    READ_AHEAD,
+    READ_BEHIND,
     get_display_preferences,
-    update_display_preferences
+    update_display_preferences,
+    get_chapter_content,
+    search_chapters
     )
+from browser_pool import browser_pool
+from scraper import fetch_chapter, scrape_chapter, iter_reader_mode_paragraphs
+from extractor import chapter_url_pattern
+from jobs import PRELOAD_QUEUE, JobWatcher, enqueue_preload, cancel_preloads, enqueue_prefetch, is_prefetch_running, run_chapter_job, queue_stats
+from scheduler import preload_scheduler
+from compression import compress_response
+from cache import library_cache, chapter_cache, preferences_cache
+from events import event_broker, SSE_KEEPALIVE, SSE_MAX_DURATION
+from export import stream_epub, stream_html_zip
+from updates import NewChapterChecker
+from hosts import host_limiter
+from search import SEARCH_PAGE_SIZE, SEARCH_PAGE_MAX, match_expression, highlight
+from metrics import registry, STAGE_SECONDS
 
-# Get the absolute path of the current file (main.py)
-current_dir = os.path.dirname(os.path.abspath(__file__))
+# Routes, registered on each application by create_app
+reader = Blueprint('reader', __name__)
 
-# Go up one level to the project root
-project_root = os.path.dirname(current_dir)
+# Quit pooled browsers when the server stops
+atexit.register(browser_pool.shutdown)
 
-load_dotenv()
+# Display preferences offered by the reading page settings, the only values stored since they are rendered into its style attribute
+MODES = ['light', 'dark']
+FONTS = ['Arial', 'Courier New', 'Georgia', 'Times New Roman', 'Verdana']
+FONT_SIZE_MIN = 8
+FONT_SIZE_MAX = 48
 
-# Initialize Flask application
-app = Flask(__name__, template_folder=os.path.join(project_root, 'templates'))
-app.secret_key = os.getenv('SECRET_KEY')
+# Library listing page size
+LIBRARY_PAGE_SIZE = int(os.getenv('LIBRARY_PAGE_SIZE', 50))
+LIBRARY_PAGE_MAX = 500
 
-# Initialize OAuth 2.0 client with Flask app
-oauth = OAuth(app)
+# Whole-novel downloads share one bounded executor, separate from the preload scheduler so they can't starve page turns
+PREFETCH_WORKERS = int(os.getenv('PREFETCH_WORKERS', 2))
+prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix='prefetch')
+prefetch_jobs = {}      # base_url > PrefetchJob of downloads in progress
+prefetch_lock = threading.Lock()
 
-# Configure Selenium options for headless execution mode
-options = Options()
-options.add_argument('--headless')
+# Metrics exposed on /metrics, the endpoint requires 'Authorization: Bearer <METRICS_TOKEN>' when METRICS_TOKEN is set
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+REQUEST_SECONDS = registry.histogram('novel_reader_request_duration_seconds', 'Duration of HTTP requests.', ('route', 'method', 'status'))
+PRELOAD_WINDOW = registry.counter('novel_reader_preload_window_total', 'Chapters opened from the read-ahead window (hit) or scraped on demand (miss).', ('result',))
+registry.gauge_function('novel_reader_preload_active_workers', 'Preload workers running a scrape.', preload_scheduler.active_count)
+registry.gauge_function('novel_reader_preload_queue_depth', 'Preloads waiting for a worker.', preload_scheduler.queue_depth)
+registry.counter_function('novel_reader_preload_completed_total', 'Preloads completed.', lambda: preload_scheduler.completed)
+registry.counter_function('novel_reader_preload_coalesced_total', 'Preloads merged into an already queued preload.', lambda: preload_scheduler.coalesced)
+registry.counter_function('novel_reader_preload_cancelled_total', 'Queued preloads dropped after the reader moved on.', lambda: preload_scheduler.cancelled)
+registry.gauge_function('novel_reader_jobs_queued', 'Jobs waiting for a worker process on the job queue.', lambda: queue_stats()['queue_depth'] if PRELOAD_QUEUE == 'database' else 0)
+registry.gauge_function('novel_reader_jobs_leased', 'Jobs being run by worker processes.', lambda: queue_stats()['active'] if PRELOAD_QUEUE == 'database' else 0)
+registry.gauge_function('novel_reader_browser_pool_size', 'Maximum number of pooled browsers.', lambda: browser_pool.size)
+registry.gauge_function('novel_reader_browser_pool_idle', 'Pooled browsers waiting for a checkout.', browser_pool.idle_count)
+registry.counter_function('novel_reader_library_cache_hits_total', 'Library renderings served from cache.', lambda: library_cache.hits)
+registry.counter_function('novel_reader_library_cache_misses_total', 'Library renderings that had to be rendered.', lambda: library_cache.misses)
+registry.counter_function('novel_reader_preferences_cache_hits_total', 'Display preferences served from cache.', lambda: preferences_cache.hits)
+registry.counter_function('novel_reader_preferences_cache_misses_total', 'Display preferences read from the database.', lambda: preferences_cache.misses)
+registry.counter_function('novel_reader_chapter_cache_hits_total', 'Chapter content served from memory.', lambda: chapter_cache.hits)
+registry.counter_function('novel_reader_chapter_cache_misses_total', 'Chapter content read from the database.', lambda: chapter_cache.misses)
+registry.counter_function('novel_reader_chapter_cache_evictions_total', 'Chapters evicted from memory to stay within CHAPTER_CACHE_BYTES.', lambda: chapter_cache.evictions)
+registry.gauge_function('novel_reader_chapter_cache_bytes', 'Size of the chapter content held in memory.', lambda: chapter_cache.size)
+registry.gauge_function('novel_reader_chapter_cache_chapters', 'Chapters held in memory.', lambda: len(chapter_cache))
+registry.gauge_function('novel_reader_event_subscribers', 'Open /api/events streams.', event_broker.subscriber_count)
+registry.gauge_function('novel_reader_prefetch_jobs', 'Whole-novel downloads in progress.', lambda: len(prefetch_jobs))
+registry.gauge_function('novel_reader_reader_updates_pending', 'Reader positions and read history waiting to be flushed.', lambda: len(reader_updates))
+registry.gauge_function('novel_reader_hosts_unavailable', 'Source sites whose circuit is open.', lambda: sum(host['circuit'] != 'closed' for host in host_limiter.stats().values()))
 
 # Google OAuth 2.0 Credentials
+# The client secret is read from GOOGLE_CLIENT_SECRET, or from the keyring (see scripts/credential.py) when the first login needs it
 GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID')
-GOOGLE_CLIENT_SECRET = keyring.get_password('oauth', 'google_client_id')
 CONF_URL = 'https://accounts.google.com/.well-known/openid-configuration'
+oauth_lock = threading.Lock()
+
+# Application factory, e.g. for a WSGI server: gunicorn 'app:create_app()'
+# Creating an application is cheap: browsers, worker threads and the OAuth client are all started on first use. 
+def create_app():
+    app = Flask(__name__, template_folder=os.path.join(project_root, 'templates'))
+    app.secret_key = os.getenv('SECRET_KEY')
+    app.register_blueprint(reader)
+    return app
+
+# Returns the application's Google OAuth 2.0 client, registered on first use
+# authlib keeps the server metadata on the client, so it is fetched by the first login only. 
+def get_google_client():
+    with oauth_lock:
+        client = current_app.extensions.get('google_oauth')
+        if client is None:
+            import keyring
+            from authlib.integrations.flask_client import OAuth
+            oauth = OAuth(current_app._get_current_object())
+            client = oauth.register('google',
+                client_id=GOOGLE_CLIENT_ID,
+                client_secret=os.getenv('GOOGLE_CLIENT_SECRET') or keyring.get_password('oauth', 'google_client_id'),
+                server_metadata_url=CONF_URL,
+                client_kwargs={
+                    'scope': 'openid'
+                }
+            )
+            current_app.extensions['google_oauth'] = client
+        return client
 
 # Login wrapper for routes
 def login_wrapper(template):
@@ -75,50 +165,120 @@ def login_required(f):
     wrapper.__name__ = f.__name__
     return wrapper
 
-@app.route('/')
+# Compression wrapper for API endpoints with large responses
+# Encodes the response with brotli or gzip as negotiated through Accept-Encoding. 
+def compressed(f):
+    def wrapper(*args, **kwargs):
+        response = make_response(f(*args, **kwargs))
+        return compress_response(response, request.headers.get('Accept-Encoding'))
+    wrapper.__name__ = f.__name__
+    return wrapper
+
+# Times every request by its route pattern, streamed responses are timed until their headers are ready
+@reader.before_app_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+# Ongoing novels are checked for new chapters from the first request on, by worker processes instead when PRELOAD_QUEUE='database'
+@reader.before_app_request
+def start_new_chapter_checker():
+    if PRELOAD_QUEUE != 'database':
+        new_chapter_checker.start()
+
+# The development server starts a thread per request: its connection is closed with the request, instead of when the thread
+# is collected. WSGI servers that reuse their threads across requests (gunicorn, waitress) keep one connection per thread. 
+@reader.teardown_app_request
+def close_request_connection(error):
+    if request.environ.get('SERVER_SOFTWARE', '').startswith('Werkzeug/'):
+        close_connection()
+
+@reader.after_app_request
+def observe_request(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_SECONDS.observe(time.perf_counter() - started, route=route, method=request.method, status=response.status_code)
+    return response
+
+# Metrics endpoint in the Prometheus text exposition format
+@reader.route('/metrics')
+def metrics():
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return abort(401)
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+@reader.route('/')
 def index():
     return login_wrapper('index.html')
 
 # Initializes OAuth 2.0 authentication flow
-# Registers OAuth 2.0 client and redirects to Google Servers user login & consent page
+# Redirects to Google Servers user login & consent page
 # https://developers.google.com/static/identity/protocols/oauth2/images/flows/authorization-code.png
-@app.route('/google')
+@reader.route('/google')
 def google():
-    oauth.register('google',
-        client_id=GOOGLE_CLIENT_ID,
-        client_secret=GOOGLE_CLIENT_SECRET,
-        server_metadata_url=CONF_URL,
-        client_kwargs={
-            'scope': 'openid'
-        }
-    )
+    from authlib.common.security import generate_token
     session['nonce'] = generate_token() 
-    return oauth.google.authorize_redirect(redirect_uri=url_for('google_auth', _external=True), nonce=session['nonce'])
+    return get_google_client().authorize_redirect(redirect_uri=url_for('.google_auth', _external=True), nonce=session['nonce'])
 
 # Google OAuth 2.0 callback
 # Receives token response and user id, then stores the user id in the session. 
-@app.route('/google/auth')
+@reader.route('/google/auth')
 def google_auth():
-    token = oauth.google.authorize_access_token()
-    user_id = oauth.google.parse_id_token(token, nonce=session['nonce'])
+    google = get_google_client()
+    token = google.authorize_access_token()
+    user_id = google.parse_id_token(token, nonce=session['nonce'])
     session['user'] = user_id.get('sub')
     return redirect('/')
 
-@app.route('/extract')
+# Reading page, rendered with the session user's display preferences so the first paint already uses them
+@reader.route('/extract')
 def extract():
-    return login_wrapper('extract.html')
+    if 'user' not in session:
+        return redirect('google')
+    mode, font, font_size = get_display_preferences(session.get('user')) or ("light", "Arial", 16)
+    # Preferences stored before they were validated fall back to the defaults
+    if mode not in MODES or font not in FONTS or parse_font_size(font_size) is None:
+        mode, font, font_size = "light", "Arial", 16
+    return render_template('extract.html', mode=mode, font=font, font_size=font_size, fonts=FONTS, font_size_min=FONT_SIZE_MIN, font_size_max=FONT_SIZE_MAX)
+
+# Returns a font size given as an integer or a string of digits when it is within the accepted range, None otherwise
+def parse_font_size(value):
+    if isinstance(value, str) and value.strip().isdigit():
+        value = int(value)
+    if type(value) is not int or not FONT_SIZE_MIN <= value <= FONT_SIZE_MAX:
+        return None
+    return value
+
+# Serves a per-user cached JSON rendering tagged with an ETag, answering a matching If-None-Match with 304.
+# (render) receives the user id and returns the payload, or None when it must not be cached. 
+def cached_json_response(key, render):
+    user_id = session.get('user')
+    cached = library_cache.get(user_id, key)
+    if cached is None:
+        payload = render(user_id)
+        if payload is None:
+            return abort(500)
+        body = current_app.json.dumps(payload)
+        etag = library_cache.put(user_id, key, body)
+    else:
+        etag, body = cached
+    response = current_app.response_class(body, mimetype='application/json')
+    response.set_etag(etag, weak=True)
+    return response.make_conditional(request)
 
 # API endpoint to get all novels for the logged-in user in session.
 # Returns server-side rendered HTML content for the novel list. 
-@app.route('/api/get_novels', methods=['GET'])
+@reader.route('/api/get_novels', methods=['GET'])
 @login_required
+@compressed
 def get_novels():
-    library = get_all_database_novels(session.get('user'))
+    return cached_json_response('html', render_novels_html)
+
+def render_novels_html(user_id):
+    library = get_all_database_novels(user_id)
     if library is None:
-        return jsonify(html_content="")
-    html_content = """<div class="row">"""
-    for novel in library:
-        html_content += """
+        return None
+    cards = ["""
             <div class="col-md-4 mb-4">
                 <div class="card h-100">
                     <div class="card-body">
@@ -138,15 +298,82 @@ def get_novels():
                 current_chapter = novel[1],
                 total_chapters = novel[2],
                 status = novel[3]
-            )
-    html_content += """
+            ) for novel in library]
+    html_content = """<div class="row">""" + "".join(cards) + """
         </div>
         <button type="submit" class="btn btn-danger mt-3" id="delete-button">Delete Selected</button>"""
-    return jsonify(html_content=html_content)
+    return {'html_content': html_content}
+
+# API endpoint to get one page of the session user's library as JSON, most recently read first.
+# Pages are chained by the opaque 'next_cursor' returned with each page, encoding the (time, base_url) of its last novel. 
+@reader.route('/api/library', methods=['GET'])
+@login_required
+@compressed
+def library_page():
+    limit = min(max(request.args.get('limit', LIBRARY_PAGE_SIZE, type=int), 1), LIBRARY_PAGE_MAX)
+    cursor_token = request.args.get('cursor')
+    cursor = decode_cursor(cursor_token) if cursor_token else None
+    if cursor_token and cursor is None:
+        return abort(400)
+    return cached_json_response(('library', cursor_token, limit), lambda user_id: render_library_page(user_id, cursor, limit))
+
+def render_library_page(user_id, cursor, limit):
+    # One extra row tells whether another page follows
+    rows = get_library_page(user_id, cursor, limit + 1)
+    if rows is None:
+        return None
+    novels = [{
+        'title': title,
+        'current_chapter': current_chapter,
+        'total_chapters': total_chapters,
+        'status': status,
+        'current_url': current_url,
+        'base_url': base_url,
+        'time': time
+        } for title, current_chapter, total_chapters, status, current_url, base_url, time in rows[:limit]]
+    next_cursor = encode_cursor(novels[-1]['time'], novels[-1]['base_url']) if len(rows) > limit else None
+    return {'novels': novels, 'next_cursor': next_cursor}
+
+def encode_cursor(time, base_url):
+    return base64.urlsafe_b64encode(json.dumps([time, base_url]).encode('utf-8')).decode('ascii')
+
+def decode_cursor(token):
+    # Returns the (time, base_url) of a cursor, or None when the token isn't a cursor made by encode_cursor
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(cursor, list) or len(cursor) != 2 or not all(isinstance(value, str) for value in cursor):
+        return None
+    return cursor[0], cursor[1]
+
+# API endpoint to search the text of the stored chapters of the session user's library.
+# Returns one page of matches, best first, each with an HTML snippet whose matched words are wrapped in <mark>. 
+@reader.route('/api/search', methods=['GET'])
+@login_required
+@compressed
+def search():
+    match = match_expression(request.args.get('q'))
+    limit = min(max(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), 1), SEARCH_PAGE_MAX)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    if match is None:
+        return abort(400)
+    # One extra row tells whether another page follows
+    rows = search_chapters(session.get('user'), match, offset, limit + 1)
+    if rows is None:
+        return abort(500)
+    results = [{
+        'title': title,
+        'base_url': base_url,
+        'chapter_number': chapter_number,
+        'url': url,
+        'snippet': highlight(snippet)
+        } for title, base_url, chapter_number, url, snippet in rows[:limit]]
+    return jsonify(results=results, next_offset=offset + limit if len(rows) > limit else None)
 
 # API endpoint to add novel to session user's library. 
 # Receives form data and updates library database. 
-@app.route('/api/add_novel', methods=['POST'])
+@reader.route('/api/add_novel', methods=['POST'])
 @login_required
 def add_novel():
     user_id = session.get('user')
@@ -161,7 +388,7 @@ def add_novel():
 
 # API endpoint to delete novels from session user's library.
 # Receives form data and updates library database. 
-@app.route('/api/delete_novels', methods=['POST'])
+@reader.route('/api/delete_novels', methods=['POST'])
 @login_required
 def delete_novels():
     novels_to_delete = request.form.getlist('delete[]')
@@ -170,125 +397,324 @@ def delete_novels():
 
 # API endpoint to handle chapter navigation
 # Determines correct URL for navigation based on current chapter and navigation specification.
-# Doesn't allow navigation while preloading. 
-@app.route('/api/navigate_chapters', methods=['POST'])
+# Only chapters already preloaded into the read-ahead window can be navigated to. 
+# 'pending' tells the reader to wait for the chapter's event on /api/events instead of clicking again. 
+@reader.route('/api/navigate_chapters', methods=['POST'])
 @login_required
 def navigate_chapters():
     url = request.get_json().get('url')
     id = request.get_json().get('id')
-    prev_url, cur_url, next_url = get_preload_urls(session.get('user'), url.split('/chapter')[0])
-    prev_ch_num, cur_ch_num, next_ch_num = get_chapter_numbers(session.get('user'), url.split('/chapter')[0])
+    base_url = url.split('/chapter')[0]
+    state = get_reader_state(session.get('user'), base_url, url, load_content=False, url_chapter_number=url_chapter_number(base_url, url))
     navigate_url = ""
+    pending = False
     # Determines the navigation url based on button clicked. 
-    # If chapter content not updated yet, don't navigate.
-    if prev_ch_num is None or cur_ch_num is None or next_ch_num is None:
-        navigate_url = ""
-    else:
-        # If in the middle of preloading, don't navigate. 
-        if prev_ch_num + 1 != cur_ch_num or cur_ch_num + 1 != next_ch_num:
-            navigate_url = ""
-        else:
-            # If on the first chapter, don't allow previous navigation
-            if id == "previousButton" and prev_url != url and cur_ch_num > 1:
-                navigate_url = prev_url
-            elif id == "nextButton" and next_url != url:
-                navigate_url = next_url
-            elif id == "homeButton" and prev_url != url and next_url != url:
-                navigate_url = "/"
-    return jsonify(navigate_url=navigate_url)
+    # If the chapter isn't preloaded yet, don't navigate.
+    if state is not None and state.chapter_number is not None:
+        # If on the first chapter, don't allow previous navigation
+        if id == "previousButton" and state.chapter_number > 1:
+            navigate_url = state.window.get(state.chapter_number - 1, "")
+            pending = navigate_url == ""
+        elif id == "nextButton":
+            navigate_url = state.window.get(state.chapter_number + 1, "")
+            pending = navigate_url == ""
+        elif id == "homeButton":
+            navigate_url = "/"
+    return jsonify(navigate_url=navigate_url, pending=pending)
+
+# API endpoint streaming preload events of the novel of 'url' as Server-Sent Events
+# A 'chapter' event is sent each time a chapter is added to the session user's read-ahead window. 
+# Each stream ends after SSE_MAX_DURATION seconds so that it doesn't hold a server thread for as long as the page is open, the browser then reconnects. 
+@reader.route('/api/events', methods=['GET'])
+@login_required
+def events():
+    url = request.args.get('url')
+    if not url or not validators.url(url):
+        return abort(404)
+    topic = (session.get('user'), url.split('/chapter')[0])
+    if PRELOAD_QUEUE == 'database':
+        job_watcher.start()
+    def stream():
+        # Subscribes inside the generator so that the subscription is released when the client disconnects
+        subscription = event_broker.subscribe(topic)
+        deadline = time.monotonic() + SSE_MAX_DURATION
+        try:
+            yield 'retry: 3000\n\n'
+            while time.monotonic() < deadline:
+                try:
+                    event = subscription.get(timeout=min(SSE_KEEPALIVE, max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                yield f'event: chapter\ndata: {json.dumps(event)}\n\n'
+        finally:
+            event_broker.unsubscribe(topic, subscription)
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 # API endpoint to extract and return content of specified 'url' chapter
-# Handles logic for retrieving chapter content and updating preloaded previous and next chapter data. 
-@app.route('/api/extract', methods=['POST'])
+# Handles logic for retrieving chapter content and refilling the read-ahead window around it. 
+# Reads the reader state in one query, buffers the position and read history (see database.reader_updates) and writes extracted content in one transaction. 
+# Clients preferring application/x-ndjson get chapters that have to be extracted streamed paragraph by paragraph (see stream_chapter). 
+# Extracted chapters are stored, and become the reader's position, at their final url after redirects, returned as 'url' for the reading page to switch to. 
+# Links naming a chapter stored at another url, e.g. the link a novel was added with, are served from the chapter store. 
+@reader.route('/api/extract', methods=['POST'])
 @login_required
+@compressed
 def extract_chapter():
     url = request.get_json().get('url')
     if not validators.url(url):
         return abort(404)
+    user_id = session.get('user')
     base_url = url.split('/chapter')[0] # novel's primary url for database query identification
-    title, chapter_number = get_chapter_title_and_number(session.get('user'), base_url)
-    prev_url, cur_url, next_url = get_preload_urls(session.get('user'), base_url)
-    
-    if url == prev_url:
-        extracted_content = get_chapter_content(session.get('user'), base_url, "previous")
-        preload_async(session.get('user'), "previous", base_url, chapter_number - 1)
-    elif url == cur_url:
-        extracted_content = get_chapter_content(session.get('user'), base_url, "current")
-        if extracted_content is None:
-            extracted_content = get_reader_mode_content(url)
-            update_chapter_content(session.get('user'), base_url, "current", chapter_number, url, extracted_content)
-        if (prev_url is None and chapter_number > 1) or next_url is None or prev_url == cur_url or cur_url == next_url:
-            preload_async(session.get('user'), "current", base_url, chapter_number)
-    elif url == next_url:
-        extracted_content = get_chapter_content(session.get('user'), base_url, "next")
-        preload_async(session.get('user'), "next", base_url, chapter_number + 1)
-    else:
+    state = get_reader_state(user_id, base_url, url, url_chapter_number=url_chapter_number(base_url, url))
+    if state is None or state.chapter_number is None:
         return abort(404)
+    chapter_number = state.chapter_number
+    extracted_content = state.content
+    reader_update = ReaderUpdate(user_id, base_url)
+    # Moving the position pointer is the whole rotation, the window follows it
+    reader_update.move_to_chapter(chapter_number, url)
+    PRELOAD_WINDOW.inc(result='hit' if extracted_content is not None else 'miss')
+    chapter_url = url
+    if extracted_content is None:
+        # Chapters another reader already loaded, or stored at the canonical url this url redirects to, aren't scraped again
+        stored_chapter = get_stored_chapter(base_url, chapter_number)
+        if stored_chapter is not None:
+            chapter_url, extracted_content = stored_chapter
+            reader_update.update_chapter_content(chapter_number, chapter_url, None)
+    if extracted_content is None and PRELOAD_QUEUE != 'database' and request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson':
+        # The position is buffered before the chapter is extracted, the content is written once it is complete
+        reader_update.update_read_history(datetime.now().isoformat())
+        reader_update.commit()
+        return Response(stream_chapter(user_id, base_url, chapter_number, url, state), mimetype='application/x-ndjson', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    if extracted_content is None and PRELOAD_QUEUE == 'database':
+        # A worker extracts and stores the chapter, only the window entry is written here
+        chapter_url = run_chapter_job(base_url, chapter_number, url) or url
+        extracted_content = get_chapter_content(chapter_url)
+        reader_update.update_chapter_content(chapter_number, chapter_url, None)
+    elif extracted_content is None:
+        final_url, extracted_content, _ = scrape_chapter(url, False)
+        if extracted_content is not None:
+            chapter_url = final_url
+        reader_update.update_chapter_content(chapter_number, chapter_url, extracted_content)
+    if chapter_url != url:
+        reader_update.move_to_chapter(chapter_number, chapter_url)
+    reader_update.update_read_history(datetime.now().isoformat())
+    reader_update.commit()
+    # Preloads are queued only once the position is buffered, so they aren't discarded as out of window
+    preload(user_id, base_url, chapter_number, state.window, state.total_chapters)
+    return jsonify(title=state.title, extracted_content=extracted_content, url=chapter_url)
+
+# Streams a chapter as NDJSON while it is extracted: a {"title"} line, one {"paragraph"} line per paragraph, then {"done": true, "url"}
+# or {"error"} when extraction fails or finds no paragraphs. The assembled chapter is stored at its final url once every paragraph is extracted. 
+# Preloads are only queued once the chapter is extracted so that they don't compete with it for browsers and the host's requests. 
+def stream_chapter(user_id, base_url, chapter_number, url, state):
+    started = time.perf_counter()
+    paragraphs = []
+    try:
+        yield json.dumps({'title': state.title}) + '\n'
+        extracted_paragraphs = iter_reader_mode_paragraphs(url)
+        chapter_url = next(extracted_paragraphs, None) or url
+        for paragraph in extracted_paragraphs:
+            if not paragraphs:
+                STAGE_SECONDS.observe(time.perf_counter() - started, stage='first_paragraph')
+            paragraphs.append(paragraph)
+            yield json.dumps({'paragraph': paragraph}) + '\n'
+        if not paragraphs:
+            # The page couldn't be loaded or has no reader content, nothing is stored
+            yield json.dumps({'error': 'Chapter extraction failed'}) + '\n'
+            return
+        reader_update = ReaderUpdate(user_id, base_url)
+        if chapter_url != url:
+            reader_update.move_to_chapter(chapter_number, chapter_url)
+        reader_update.update_chapter_content(chapter_number, chapter_url, ''.join(f'<p>{html.escape(paragraph)}</p>' for paragraph in paragraphs))
+        reader_update.commit()
+        yield json.dumps({'done': True, 'url': chapter_url}) + '\n'
+    except Exception as error:
+        logging.error(f'Error in stream_chapter: {error}')
+        yield json.dumps({'error': 'Chapter extraction failed'}) + '\n'
+    finally:
+        preload(user_id, base_url, chapter_number, state.window, state.total_chapters)
 
-    update_read_history(session.get('user'), base_url, datetime.now().isoformat())
-    return jsonify(title=title, extracted_content=extracted_content)
+# Returns the chapter number named by a chapter url of the novel at (base_url), e.g. '{base_url}/chapter-12', or None
+def url_chapter_number(base_url, url):
+    match = chapter_url_pattern(base_url).match(url)
+    return int(match.group(1)) if match else None
 
 # Asynchronously preload chapter content
-# Starts a new thread to run preload function in the background. 
-def preload_async(user_id, case, base_url, chapter_number):
-    threading.Thread(target=preload, args=(user_id, case, base_url, chapter_number), daemon=True).start()
+# Queues a scrape on the preload scheduler's bounded worker pool, or on the durable job queue for worker processes (see PRELOAD_QUEUE). 
+# Jobs for the same chapter are coalesced. Lower (priority) is scraped first on the job queue, the scheduler runs jobs in submission order. 
+def preload_async(user_id, base_url, chapter_number, priority=1):
+    if PRELOAD_QUEUE == 'database':
+        enqueue_preload(user_id, base_url, chapter_number, priority)
+    else:
+        preload_scheduler.submit((user_id, base_url, chapter_number), (user_id, base_url), preload_chapter, user_id, base_url, chapter_number)
 
 # Preload chapter content for smooth navigation
-# Handles different preloading cases to ensure that previous, current, and next chapters are always available for quick access. 
-def preload(user_id, case, base_url, chapter_number):
+# Refills the read-ahead window around the reader's chapter in the background. 
+# Queued scrapes for the reader's old position are cancelled. 
+def preload(user_id, base_url, chapter_number, window, total_chapters):
     """
     Precondition:
-        The database contains: [previous, current, next]
+        (window) maps the chapter numbers already preloaded to their url
 
     Postcondition:
-        Depending on the case:
-        - "previous" case: [new_previous, previous, current]    >   [previous, current, next]
-        - "current" case:  [new_previous, current, new_current] >   [previous, current, next]
-        - "next" case:     [current, next, new_next]            >   [previous, current, next]
+        Every chapter from READ_BEHIND behind to READ_AHEAD ahead of (chapter_number) that is missing from the window is queued,
+        nearest first and ahead before behind, so that the next page turn is preloaded before the rest.
+        Past (total_chapters) only the next chapter is queued, since the novel may have been updated after it was added.
     """
-    if case == "current":
-        if chapter_number > 1:
-            preload_chapter(user_id, base_url, "previous", chapter_number - 1)
-        preload_chapter(user_id, base_url, "next", chapter_number + 1)
-    elif case in ["previous", "next"]:
-        move_chapter(user_id, base_url, "next" if case == "previous" else "previous", "current")
-        move_chapter(user_id, base_url, "current", case)
-        preload_chapter_number = chapter_number - 1 if case == "previous" else chapter_number + 1
-        if case == "previous" and chapter_number > 1 or case == "next":
-            preload_chapter(user_id, base_url, case, preload_chapter_number)
-
-def preload_chapter(user_id, base_url, position, chapter_number):
-    preload_url = get_url_redirect(f"{base_url}/chapter-{chapter_number}")
-    if preload_url:
-        preload_content = get_reader_mode_content(preload_url)
-        update_chapter_content(user_id, base_url, position, chapter_number, preload_url, preload_content)
-
-# Uses Selenium webdriver to return url redirect
-def get_url_redirect(url):
-    try:
-        with webdriver.Firefox(options=options) as driver:
-            driver.get(url)
-            return driver.current_url
-    except Exception as error:
-        logging.error(f'Error in get_url_redirect: {error}')
-        return None
+    if PRELOAD_QUEUE == 'database':
+        # Worker processes check preloads against the stored position, which can't wait for the next flush
+        reader_updates.flush([(user_id, base_url)])
+        cancel_preloads(user_id, base_url)
+    else:
+        preload_scheduler.supersede((user_id, base_url))
+    first_chapter = max(1, chapter_number - READ_BEHIND)
+    last_chapter = chapter_number + READ_AHEAD
+    if total_chapters and last_chapter > total_chapters:
+        last_chapter = max(total_chapters, chapter_number + 1)
+    missing_chapters = [number for number in range(first_chapter, last_chapter + 1) if number != chapter_number and number not in window]
+    for priority, number in enumerate(sorted(missing_chapters, key=lambda number: (abs(number - chapter_number), number < chapter_number)), 1):
+        preload_async(user_id, base_url, number, priority)
 
-# Extracts the reader view content of given url
-# Uses Selenium webdriver to render page and extract text from reader view. 
-def get_reader_mode_content(url):
-    if url is None:
-        return None
+# Adds a chapter to the reader's read-ahead window once it is fetched
+# Readers waiting for it are notified through the event broker
+def preload_chapter(user_id, base_url, chapter_number):
+    chapter_url, _ = fetch_chapter(base_url, chapter_number)
+    if chapter_url:
+        update_chapter_content(user_id, base_url, chapter_number, chapter_url, None)
+        publish_preload(user_id, base_url, chapter_number, chapter_url)
+
+def publish_preload(user_id, base_url, chapter_number, chapter_url):
+    event_broker.publish((user_id, base_url), {'chapter_number': chapter_number, 'url': chapter_url})
+
+# Preloads finished by worker processes are published to this process's readers
+job_watcher = JobWatcher(publish_preload)
+
+# New chapters within a reader's read-ahead window are preloaded as soon as they are found
+new_chapter_checker = NewChapterChecker(preload_async)
+
+class PrefetchJob:
+    # Counts down the chapters of one whole-novel download, the last finished chapter records the job's outcome
+    def __init__(self, base_url, remaining):
+        self.base_url = base_url
+        self.remaining = remaining
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def chapter_done(self, success):
+        with self.lock:
+            self.remaining -= 1
+            self.failed += 0 if success else 1
+            finished = self.remaining == 0
+        if finished:
+            with prefetch_lock:
+                prefetch_jobs.pop(self.base_url, None)
+            finish_prefetch_job(self.base_url, self.failed, datetime.now().isoformat())
+
+# Starts downloading every chapter (1..total_chapters) of a novel into the shared chapter store.
+# Chapters already stored are skipped, so starting an interrupted or incomplete job again resumes it. 
+# Returns False when the novel is already being downloaded. 
+def start_prefetch(base_url, total_chapters):
+    if PRELOAD_QUEUE == 'database':
+        return start_prefetch_jobs(base_url, total_chapters)
+    with prefetch_lock:
+        if base_url in prefetch_jobs:
+            return False
+        stored_chapters = get_stored_chapter_numbers(base_url)
+        missing_chapters = [number for number in range(1, total_chapters + 1) if number not in stored_chapters]
+        start_prefetch_job(base_url, total_chapters, datetime.now().isoformat())
+        if not missing_chapters:
+            finish_prefetch_job(base_url, 0, datetime.now().isoformat())
+            return True
+        job = PrefetchJob(base_url, len(missing_chapters))
+        prefetch_jobs[base_url] = job
+    for number in missing_chapters:
+        prefetch_executor.submit(prefetch_chapter, job, number)
+    return True
+
+# Enqueues the missing chapters of a whole-novel download for worker processes, the worker finishing the last one records the outcome
+def start_prefetch_jobs(base_url, total_chapters):
+    if is_prefetch_running(base_url):
+        return False
+    stored_chapters = get_stored_chapter_numbers(base_url)
+    missing_chapters = [number for number in range(1, total_chapters + 1) if number not in stored_chapters]
+    start_prefetch_job(base_url, total_chapters, datetime.now().isoformat())
+    if not missing_chapters:
+        finish_prefetch_job(base_url, 0, datetime.now().isoformat())
+    for number in missing_chapters:
+        enqueue_prefetch(base_url, number)
+    return True
+
+def prefetch_chapter(job, chapter_number):
+    success = False
     try:
-        with webdriver.Firefox(options=options) as driver:
-            driver.get(f'about:reader?url={url}')
-            reader_content = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.CLASS_NAME, 'moz-reader-content')))
-            paragraphs = WebDriverWait(reader_content, 10).until(EC.presence_of_all_elements_located((By.TAG_NAME, 'p')))
-            return "".join(f'<p>{paragraph.text}</p>' for paragraph in paragraphs)
+        _, content = fetch_chapter(job.base_url, chapter_number)
+        success = content is not None
     except Exception as error:
-        logging.error(f'Error in get_reader_mode_content: {error}')
-        return None
+        logging.error(f'Error in prefetch_chapter: {error}')
+    finally:
+        job.chapter_done(success)
+
+# API endpoint to download a whole novel of the session user's library for offline reading
+# POST starts (or resumes) the download, GET reports its progress. 
+@reader.route('/api/prefetch', methods=['GET', 'POST'])
+@login_required
+def prefetch():
+    base_url = request.values.get('base_url') or (request.get_json(silent=True) or {}).get('base_url')
+    state = get_reader_state(session.get('user'), base_url, load_content=False) if base_url else None
+    if state is None:
+        return abort(404)
+    if request.method == 'POST':
+        if not state.total_chapters:
+            return abort(400)
+        start_prefetch(base_url, state.total_chapters)
+    progress = get_prefetch_progress(base_url)
+    if progress is None:
+        return jsonify(status='not_started', total_chapters=state.total_chapters, downloaded_chapters=0, failed_chapters=0)
+    status, total_chapters, downloaded_chapters, failed_chapters = progress
+    return jsonify(status=status, total_chapters=total_chapters, downloaded_chapters=downloaded_chapters, failed_chapters=failed_chapters)
 
-@app.route('/api/get_display_preferences', methods=['GET'])
+# API endpoint to export the downloaded chapters of a novel as an EPUB book or a zipped HTML bundle
+# The archive is streamed chapter by chapter. 
+@reader.route('/api/export', methods=['GET'])
+@login_required
+def export_novel():
+    base_url = request.args.get('base_url')
+    export_format = request.args.get('format', 'epub')
+    state = get_reader_state(session.get('user'), base_url, load_content=False) if base_url else None
+    if state is None or export_format not in ('epub', 'zip'):
+        return abort(404)
+    last_chapter = state.total_chapters or max(get_stored_chapter_numbers(base_url), default=0)
+    if last_chapter < 1:
+        return abort(404)
+    chapters = iter_stored_chapters(base_url, 1, last_chapter)
+    filename = ''.join(character if character.isalnum() else '_' for character in state.title)
+    if export_format == 'epub':
+        return Response(stream_epub(state.title, base_url, chapters), mimetype='application/epub+zip',
+            headers={'Content-Disposition': f'attachment; filename="{filename}.epub"'})
+    return Response(stream_html_zip(state.title, chapters), mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename="{filename}.zip"'})
+
+# API endpoint reporting the preload scheduler's, or the job queue's, queue depth and job counters
+@reader.route('/api/preload_status', methods=['GET'])
+@login_required
+def preload_status():
+    return jsonify(queue_stats() if PRELOAD_QUEUE == 'database' else preload_scheduler.stats())
+
+# API endpoint reporting this process's chapter cache size and hit rate
+@reader.route('/api/cache_status', methods=['GET'])
+@login_required
+def cache_status():
+    return jsonify(chapter_cache.stats())
+
+# API endpoint reporting this process's politeness state and request counters per source site
+@reader.route('/api/host_status', methods=['GET'])
+@login_required
+def host_status():
+    return jsonify(host_limiter.stats())
+
+@reader.route('/api/get_display_preferences', methods=['GET'])
 @login_required
 def api_get_display_preferences():
     user_id = session.get('user')
@@ -299,14 +725,16 @@ def api_get_display_preferences():
         'font_size': font_size
     })
 
-@app.route('/api/update_display_preferences', methods=['POST'])
+@reader.route('/api/update_display_preferences', methods=['POST'])
 @login_required
 def api_update_display_preferences():
     user_id = session.get('user')
-    data = request.get_json()
+    data = request.get_json(silent=True) or {}
     mode = data.get('mode')
     font = data.get('font')
-    font_size = data.get('font_size')
+    font_size = parse_font_size(data.get('font_size'))
+    if mode not in MODES or font not in FONTS or font_size is None:
+        return abort(400)
     try:
         update_display_preferences(user_id, mode, font, font_size)
         return jsonify({'status': 'success'})
@@ -314,5 +742,7 @@ def api_update_display_preferences():
         logging.error(f'Error updating display preferences: {error}')
         return jsonify({'status': 'error'})
 
+app = create_app()
+
 if __name__ == '__main__':
     app.run(host="0.0.0.0", port=8000, debug=True, use_reloader=True)
\ No newline at end of file
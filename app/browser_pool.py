@@ -0,0 +1,106 @@
+import os
+import queue
+import logging
+import threading
+from contextlib import contextmanager
+
+from metrics import STAGE_SECONDS
+
+BROWSER_POOL_SIZE = int(os.getenv('BROWSER_POOL_SIZE', 2))
+BROWSER_MAX_PAGES = int(os.getenv('BROWSER_MAX_PAGES', 50))
+BROWSER_CHECKOUT_TIMEOUT = float(os.getenv('BROWSER_CHECKOUT_TIMEOUT', 60))
+
+def create_firefox_driver():
+    # Selenium is imported by the first launch, processes that never launch a browser don't load it
+    from selenium import webdriver
+    from selenium.webdriver.firefox.options import Options
+    # Configure Selenium options for headless execution mode
+    options = Options()
+    options.add_argument('--headless')
+    return webdriver.Firefox(options=options)
+
+class PooledDriver:
+    # Webdriver together with the number of pages it has loaded since launch
+    def __init__(self, driver):
+        self.driver = driver
+        self.pages = 0
+
+class BrowserPool:
+    """
+    Bounded pool of long-lived webdrivers.
+
+    At most (size) browsers exist at once. Callers borrow one with driver() and it is returned when the block exits.
+    A browser is recycled after (max_pages) checkouts, or discarded when it fails a health check (e.g. after a crash).
+    """
+    def __init__(self, size=BROWSER_POOL_SIZE, max_pages=BROWSER_MAX_PAGES, factory=create_firefox_driver):
+        self.size = size
+        self.max_pages = max_pages
+        self.factory = factory
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def driver(self, timeout=BROWSER_CHECKOUT_TIMEOUT):
+        with STAGE_SECONDS.time(stage='browser_wait'):
+            acquired = self._slots.acquire(timeout=timeout)
+        if not acquired:
+            raise TimeoutError(f'No browser available after {timeout}s')
+        entry = None
+        try:
+            entry = self._checkout()
+            try:
+                yield entry.driver
+            finally:
+                entry.pages += 1
+                if not self._is_healthy(entry):
+                    self._quit(entry)
+                    entry = None
+        finally:
+            if entry is not None:
+                self._checkin(entry)
+            self._slots.release()
+
+    def shutdown(self):
+        # Quits every idle browser; browsers checked out at the time are quit when returned
+        while True:
+            try:
+                self._quit(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+    def idle_count(self):
+        return self._idle.qsize()
+
+    def _checkout(self):
+        # Reuse the most recently returned healthy browser, otherwise launch a new one
+        while True:
+            try:
+                entry = self._idle.get_nowait()
+            except queue.Empty:
+                with STAGE_SECONDS.time(stage='browser_launch'):
+                    return PooledDriver(self.factory())
+            if self._is_healthy(entry):
+                return entry
+            self._quit(entry)
+
+    def _checkin(self, entry):
+        if entry.pages >= self.max_pages:
+            self._quit(entry)
+        else:
+            self._idle.put(entry)
+
+    def _is_healthy(self, entry):
+        # Any round trip to the browser fails once its process or session has died
+        try:
+            entry.driver.current_url
+            return True
+        except Exception:
+            return False
+
+    def _quit(self, entry):
+        try:
+            entry.driver.quit()
+        except Exception as error:
+            logging.error(f'Error quitting pooled browser: {error}')
+
+browser_pool = BrowserPool()
@@ -0,0 +1,151 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+LIBRARY_CACHE_USERS = int(os.getenv('LIBRARY_CACHE_USERS', 1000))
+LIBRARY_CACHE_TTL = float(os.getenv('LIBRARY_CACHE_TTL', 30))
+CHAPTER_CACHE_BYTES = int(os.getenv('CHAPTER_CACHE_BYTES', 67108864))
+PREFERENCES_CACHE_TTL = float(os.getenv('PREFERENCES_CACHE_TTL', 300))
+
+class LibraryCache:
+    """
+    Rendered library responses per user, keyed by (user_id, key) where key names the rendering (e.g. a page of the JSON listing).
+    Writes to a user's library invalidate all of the user's entries. The cache is per process, so entries also expire after
+    (ttl) seconds to pick up writes made by other workers. The least recently used users are evicted beyond (max_users).
+    """
+    def __init__(self, max_users=LIBRARY_CACHE_USERS, ttl=LIBRARY_CACHE_TTL):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._users = OrderedDict()     # user_id > {key: (expires at, etag, body)}
+        self._lock = threading.Lock()
+
+    def get(self, user_id, key):
+        # Returns (etag, body) or None
+        with self._lock:
+            entries = self._users.get(user_id)
+            entry = entries.get(key) if entries else None
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self._users.move_to_end(user_id)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def put(self, user_id, key, body):
+        # Stores a rendered body and returns its etag
+        etag = hashlib.sha1(body if isinstance(body, bytes) else body.encode('utf-8')).hexdigest()
+        with self._lock:
+            self._users.setdefault(user_id, {})[key] = (time.monotonic() + self.ttl, etag, body)
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        return etag
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._users.pop(user_id, None)
+
+library_cache = LibraryCache()
+
+class ChapterCache:
+    """
+    Decoded chapter content keyed by canonical chapter url, shared by every user.
+    Content of a url only changes when the chapter is stored again, which writes through to this cache, so entries don't expire.
+    The least recently used chapters are evicted once the UTF-8 size of the cached content exceeds (max_bytes).
+    """
+    def __init__(self, max_bytes=CHAPTER_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._chapters = OrderedDict()  # url > (content, size in bytes)
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        # Returns the content or None
+        with self._lock:
+            entry = self._chapters.get(url)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._chapters.move_to_end(url)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, url, content):
+        if content is None:
+            return
+        size = len(content.encode('utf-8'))
+        with self._lock:
+            previous = self._chapters.pop(url, None)
+            if previous is not None:
+                self.size -= previous[1]
+            if size > self.max_bytes:
+                return
+            self._chapters[url] = (content, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self._chapters.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._chapters)
+
+    def stats(self):
+        # Size, limit and lookup counters with the hit rate since the process started
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'chapters': len(self._chapters),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+chapter_cache = ChapterCache()
+
+class PreferencesCache:
+    """
+    Display preferences per user, invalidated when the user saves new preferences.
+    Entries expire after (ttl) seconds to pick up preferences saved through other workers, the least recently used users are evicted beyond (max_users).
+    """
+    def __init__(self, max_users=LIBRARY_CACHE_USERS, ttl=PREFERENCES_CACHE_TTL):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._users = OrderedDict()     # user_id > (expires at, preferences)
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        # Returns the preferences or None
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self._users.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, user_id, preferences):
+        with self._lock:
+            self._users[user_id] = (time.monotonic() + self.ttl, preferences)
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._users.pop(user_id, None)
+
+preferences_cache = PreferencesCache()
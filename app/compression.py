@@ -0,0 +1,71 @@
+import os
+import gzip
+import zlib
+
+# Brotli is optional, responses fall back to gzip without it
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+"""
+Stored content codec
+Chapter content is stored as a BLOB whose first byte names the codec. Legacy rows hold plain TEXT and are returned unchanged.
+"""
+CONTENT_CODEC = os.getenv('CONTENT_CODEC', 'zlib')     # 'zlib' or 'plain'
+CODEC_PLAIN = b'\x00'
+CODEC_ZLIB = b'\x01'
+
+def encode_content(content):
+    if content is None:
+        return None
+    data = content.encode('utf-8')
+    if CONTENT_CODEC == 'zlib':
+        return CODEC_ZLIB + zlib.compress(data, 6)
+    return CODEC_PLAIN + data
+
+def decode_content(value):
+    if value is None or isinstance(value, str):
+        return value
+    codec, data = value[:1], value[1:]
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data).decode('utf-8')
+    if codec == CODEC_PLAIN:
+        return data.decode('utf-8')
+    raise ValueError(f'Unknown content codec {codec!r}')
+
+"""
+HTTP response compression
+Responses are compressed with the best encoding the client accepts: brotli, then gzip.
+"""
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 500))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+def accepted_encodings(header):
+    # Returns the encodings of an Accept-Encoding header that aren't refused with q=0
+    encodings = set()
+    for item in (header or '').split(','):
+        name, _, params = item.strip().partition(';')
+        params = params.replace(' ', '')
+        if name and params not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            encodings.add(name.lower())
+    return encodings
+
+def compress_response(response, accept_encoding):
+    # Compresses a Flask response in place according to the request's Accept-Encoding header
+    response.vary.add('Accept-Encoding')
+    # Streamed responses are sent as they are produced, compressing them would buffer them whole
+    if response.direct_passthrough or response.is_streamed or response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    encodings = accepted_encodings(accept_encoding)
+    if brotli is not None and 'br' in encodings:
+        response.set_data(brotli.compress(data, quality=BROTLI_QUALITY))
+        response.headers['Content-Encoding'] = 'br'
+    elif 'gzip' in encodings or '*' in encodings:
+        response.set_data(gzip.compress(data, compresslevel=GZIP_LEVEL))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
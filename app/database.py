@@ -1,217 +1,789 @@
+import os
+import json
 import sqlite3
 import logging
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+from cache import library_cache, chapter_cache, preferences_cache
+from compression import encode_content, decode_content
+from search import chapter_text, MATCH_START, MATCH_END, SNIPPET_TOKENS
+from metrics import timed
+from writebehind import WriteBehindBuffer
 
 DATABASE_NAME = 'library.db'
 LIBRARY_TABLE = 'library'
 DISPLAY_TABLE = 'display_preferences'
+CHAPTERS_TABLE = 'chapters'
+WINDOW_TABLE = 'reading_window'
+PREFETCH_TABLE = 'prefetch_jobs'
+INDEX_TABLE = 'chapter_index'
+JOBS_TABLE = 'jobs'
+SEARCH_TABLE = 'chapter_search'
+CHECKS_TABLE = 'novel_checks'
+# Schema version (PRAGMA user_version) these queries are written for, the last migration of scripts/create_db.py
+SCHEMA_VERSION = 11
+
+# Read-ahead window: chapters kept preloaded around the reader's current chapter
+READ_AHEAD = int(os.getenv('READ_AHEAD', 5))
+READ_BEHIND = int(os.getenv('READ_BEHIND', 1))
+
+# Write-behind of reader positions and read history: at most READER_FLUSH_INTERVAL seconds of reading is lost on a crash, 0 writes through
+READER_FLUSH_INTERVAL = float(os.getenv('READER_FLUSH_INTERVAL', 1))
+READER_BUFFER_MAX = int(os.getenv('READER_BUFFER_MAX', 10000))
+
+# Connection tuning
+BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+STATEMENT_CACHE_SIZE = int(os.getenv('SQLITE_STATEMENT_CACHE_SIZE', 256))
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',                  # readers no longer block on the preload writers
+    'PRAGMA synchronous=NORMAL',                # durable at checkpoints, safe with WAL
+    'PRAGMA cache_size=-{}'.format(int(os.getenv('SQLITE_CACHE_KB', 16384))),
+    'PRAGMA busy_timeout={}'.format(BUSY_TIMEOUT_MS),
+    'PRAGMA mmap_size={}'.format(int(os.getenv('SQLITE_MMAP_BYTES', 134217728))),
+    'PRAGMA temp_store=MEMORY'
+)
 
 """
 (user_id) is unique identifier for logged-in user
 (base_url) is unique identifier (primary url) for novel
+(url) in the chapters table is the canonical url of a chapter, its content is shared by every user
+Library rows hold the reader's position (current_chapter, current_url); the reading_window table lists the chapters
+preloaded around it, from READ_BEHIND chapters behind to READ_AHEAD chapters ahead
+Chapter content is written compressed (see compression.encode_content), reads accept both compressed and legacy plain-text rows
+The text of stored chapters is indexed for full-text search in the same transaction (see search.py)
+Page turns don't write: positions and read history wait in the reader_updates buffer (see writebehind.py) and are flushed
+in batches, reads of the library and of the reader state merge the pending ones
 """
 
+_local = threading.local()
+
+def get_connection():
+    """
+    Returns the calling thread's persistent connection, opened and tuned on first use.
+    Statements are cached per connection, so reusing the connection also reuses prepared statements.
+    Write transactions use BEGIN IMMEDIATE so that they wait on busy_timeout instead of failing on lock upgrade.
+    Raises sqlite3.DatabaseError for a database older than SCHEMA_VERSION: migrations may rewrite what the app stores
+    (e.g. escape_chapter_paragraphs), so nothing is read or written before scripts/create_db.py has run.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DATABASE_NAME, timeout=BUSY_TIMEOUT_MS / 1000, cached_statements=STATEMENT_CACHE_SIZE)
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version < SCHEMA_VERSION:
+            conn.close()
+            raise sqlite3.DatabaseError(f'{DATABASE_NAME} has schema version {version}, run scripts/create_db.py to migrate it to version {SCHEMA_VERSION}')
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        _local.conn = conn
+    return conn
+
+def close_connection():
+    # Closes the calling thread's connection, the next call to get_connection reopens it
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        _local.conn = None
+        conn.close()
+
+@timed
 def add_database_novel(user_id, title, current_chapter, total_chapters, status, link, base_url, time):
-    conn = None
+    conn = get_connection()
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        conn.execute('BEGIN TRANSACTION')
+        conn.execute('BEGIN IMMEDIATE')
         c = conn.cursor()
-        c.execute('SELECT COUNT(*) FROM {} WHERE user_id=? AND base_url=?'.format(LIBRARY_TABLE), (user_id, base_url))
-        if c.fetchone()[0] == 0:
-            c.execute('INSERT INTO library (user_id, title, current_chapter, total_chapters, status, current_url, base_url, time) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (user_id, title, current_chapter, total_chapters, status, link, base_url, time))
-            conn.commit()
-        else:
-            conn.rollback()
+        c.execute('INSERT INTO {} (user_id, title, current_chapter, total_chapters, status, current_url, base_url, time) VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(user_id, base_url) DO NOTHING'.format(LIBRARY_TABLE), (user_id, title, current_chapter, total_chapters, status, link, base_url, time))
+        conn.commit()
+        library_cache.invalidate(user_id)
+        if c.rowcount == 0:
             logging.error('Attempting to add duplicate novel')
-
     except sqlite3.Error as error:
-        if conn:
-            conn.rollback()
+        conn.rollback()
         logging.error(f'Error in add_database_novel: {error}')
-    finally:
-        if conn:
-            conn.close()
 
+@timed
 def delete_database_novels(user_id, novels_to_delete):
-    conn = None
+    conn = get_connection()
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        conn.execute('BEGIN TRANSACTION')
+        conn.execute('BEGIN IMMEDIATE')
         c = conn.cursor()
-        for base_url in novels_to_delete:
-            c.execute('DELETE FROM {} WHERE user_id=? AND base_url=?'.format(LIBRARY_TABLE), (user_id, base_url,))
+        novels = [(user_id, base_url) for base_url in novels_to_delete]
+        c.executemany('DELETE FROM {} WHERE user_id=? AND base_url=?'.format(LIBRARY_TABLE), novels)
+        c.executemany('DELETE FROM {} WHERE user_id=? AND base_url=?'.format(WINDOW_TABLE), novels)
         conn.commit()
+        for novel in novels:
+            reader_updates.discard(novel)
+        library_cache.invalidate(user_id)
     except sqlite3.Error as error:
-        if conn:
-            conn.rollback()
+        conn.rollback()
         logging.error(f'Error in delete_database_novels: {error}')
-    finally:
-        if conn:
-            conn.close()
 
+@timed
 def get_all_database_novels(user_id):
-    conn = None
+    pending = _pending_reads(user_id)
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        c = conn.cursor()
-        c.execute('SELECT title, current_chapter, total_chapters, status, current_url, base_url FROM {} WHERE user_id=? ORDER BY datetime(time) DESC'.format(LIBRARY_TABLE), (user_id,))
+        c = get_connection().cursor()
+        c.execute('SELECT title, current_chapter, total_chapters, status, current_url, base_url, time FROM {} WHERE user_id=? ORDER BY time DESC'.format(LIBRARY_TABLE), (user_id,))
         library = c.fetchall()
-        return library
+        if pending:
+            library = _merge_pending_reads(c, user_id, library, pending)
+        return [row[:6] for row in library]
     except sqlite3.Error as error:
         logging.error(f'Error in get_all_database_novels: {error}')
-    finally:
-        if conn:
-            conn.close()
 
-def get_preload_urls(user_id, url):
-    # Returns previous, current, and next url
-    conn = None
+@timed
+def get_library_page(user_id, cursor, limit):
+    """
+    Returns up to (limit) novels ordered by most recently read, as (title, current_chapter, total_chapters, status, current_url, base_url, time) rows.
+    (cursor) is the (time, base_url) of the last novel of the previous page, or None for the first page.
+    Reads not flushed yet are merged in, the stored rows of their novels are read past (limit) to make up for them.
+    """
+    pending = _pending_reads(user_id)
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        c = conn.cursor()
-        c.execute('SELECT previous_url, current_url, next_url FROM {} WHERE user_id=? AND base_url=?'.format(LIBRARY_TABLE), (user_id, url,))
-        result = c.fetchone()
-        if result is None:
-            return (None, None, None)
+        c = get_connection().cursor()
+        if cursor is None:
+            c.execute('SELECT title, current_chapter, total_chapters, status, current_url, base_url, time FROM {} WHERE user_id=? ORDER BY time DESC, base_url DESC LIMIT ?'.format(LIBRARY_TABLE), (user_id, limit + len(pending)))
         else:
-            return result
+            c.execute('SELECT title, current_chapter, total_chapters, status, current_url, base_url, time FROM {} WHERE user_id=? AND (time, base_url) < (?, ?) ORDER BY time DESC, base_url DESC LIMIT ?'.format(LIBRARY_TABLE), (user_id, cursor[0], cursor[1], limit + len(pending)))
+        rows = c.fetchall()
+        if pending:
+            rows = _merge_pending_reads(c, user_id, rows, pending, cursor)
+        return rows[:limit]
     except sqlite3.Error as error:
-        logging.error(f'Error in get_preload_urls: {error}')
-    finally:
-        if conn:
-            conn.close()
+        logging.error(f'Error in get_library_page: {error}')
 
-def get_chapter_numbers(user_id, url):
-    # Returns previous, current, and next chapter number
-    conn = None
+@timed
+def get_stored_chapter(base_url, chapter_number):
+    # Returns (url, content) of a chapter already in the shared chapter store, or None
+    # Content is read from the chapter cache when it holds the chapter's url
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        c = conn.cursor()
-        c.execute('SELECT previous_chapter, current_chapter, next_chapter FROM {} WHERE user_id=? AND base_url=?'.format(LIBRARY_TABLE), (user_id, url,)) 
+        c = get_connection().cursor()
+        c.execute('SELECT url FROM {} WHERE base_url=? AND chapter_number=? ORDER BY fetched_at DESC LIMIT 1'.format(CHAPTERS_TABLE), (base_url, chapter_number,))
         result = c.fetchone()
-        return (None, None, None) if result is None else result
+        if result is None:
+            return None
+        url = result[0]
+        content = chapter_cache.get(url)
+        if content is None:
+            c.execute('SELECT content FROM {} WHERE url=?'.format(CHAPTERS_TABLE), (url,))
+            content = decode_content(c.fetchone()[0])
+            chapter_cache.put(url, content)
+        return url, content
     except sqlite3.Error as error:
-        logging.error(f'Error in get_chapter_numbers: {error}')
-    finally:
-        if conn:
-            conn.close()
+        logging.error(f'Error in get_stored_chapter: {error}')
 
-def get_chapter_title_and_number(user_id, url):
-    # Returns current title and chapter number 
-    conn = None
+@timed
+def get_chapter_content(url):
+    # Returns the stored content of the chapter at (url), or None
+    content = chapter_cache.get(url)
+    if content is not None:
+        return content
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        conn.execute('BEGIN TRANSACTION')
-        c = conn.cursor()
-        c.execute('SELECT title, current_chapter FROM {} WHERE user_id=? AND base_url=?'.format(LIBRARY_TABLE), (user_id, url,)) 
+        c = get_connection().cursor()
+        c.execute('SELECT content FROM {} WHERE url=?'.format(CHAPTERS_TABLE), (url,))
         result = c.fetchone()
-        return (None, None) if result is None else result
+        if result is None:
+            return None
+        content = decode_content(result[0])
+        chapter_cache.put(url, content)
+        return content
     except sqlite3.Error as error:
-        logging.error(f'Error in get_chapter_title_and_number: {error}')
-    finally:
-        if conn:
-            conn.close()
+        logging.error(f'Error in get_chapter_content: {error}')
 
-def get_chapter_content(user_id, url, case):
-    # Returns chapter content of specified case: previous, current, or next chapter 
-    conn = None
+@timed
+def get_indexed_chapter(base_url, chapter_number):
+    # Returns (url, resolved_at) of a chapter in the chapter index, or None
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        conn.execute('BEGIN TRANSACTION')
-        c = conn.cursor()
-        c.execute('SELECT {}_content FROM {} WHERE user_id=? AND base_url=?'.format(case, LIBRARY_TABLE), (user_id, url,)) 
-        result = c.fetchone()
-        return "" if result is None else result[0]
+        c = get_connection().cursor()
+        c.execute('SELECT url, resolved_at FROM {} WHERE base_url=? AND chapter_number=?'.format(INDEX_TABLE), (base_url, chapter_number))
+        return c.fetchone()
     except sqlite3.Error as error:
-        logging.error(f'Error in get_chapter_content: {error}')
-    finally:
-        if conn:
-            conn.close()
+        logging.error(f'Error in get_indexed_chapter: {error}')
+
+@timed
+def index_chapter_urls(base_url, chapter_urls, time):
+    # Records the canonical url of every chapter of (chapter_urls), a {chapter number: url} mapping
+    conn = get_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.executemany('INSERT INTO {} (base_url, chapter_number, url, resolved_at) VALUES (?, ?, ?, ?) ON CONFLICT(base_url, chapter_number) DO UPDATE SET url=excluded.url, resolved_at=excluded.resolved_at'.format(INDEX_TABLE),
+            [(base_url, chapter_number, url, time) for chapter_number, url in chapter_urls.items()])
+        conn.commit()
+    except sqlite3.Error as error:
+        conn.rollback()
+        logging.error(f'Error in index_chapter_urls: {error}')
+
+@timed
+def unindex_chapter(base_url, chapter_number):
+    # Forgets the indexed url of a chapter that no longer resolves
+    conn = get_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('DELETE FROM {} WHERE base_url=? AND chapter_number=?'.format(INDEX_TABLE), (base_url, chapter_number))
+        conn.commit()
+    except sqlite3.Error as error:
+        conn.rollback()
+        logging.error(f'Error in unindex_chapter: {error}')
 
-def update_chapter_content(user_id, base_url, case, chapter_number, url, content):
-    # Updates chapter number, url, and content of specified case (previous, current or next chapter)
-    conn = None
+@timed
+def store_chapter(url, base_url, chapter_number, content):
+    # Writes chapter content to the shared chapter store without touching any reader's window
+    conn = get_connection()
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        conn.execute('BEGIN TRANSACTION')
+        conn.execute('BEGIN IMMEDIATE')
+        _store_chapter(conn.cursor(), url, base_url, chapter_number, content)
+        conn.commit()
+        chapter_cache.put(url, content)
+    except sqlite3.Error as error:
+        conn.rollback()
+        logging.error(f'Error in store_chapter: {error}')
+
+@timed
+def iter_stored_chapters(base_url, first_chapter, last_chapter):
+    # Yields (chapter number, content) of stored chapters in order, one row at a time so that a whole novel is never in memory
+    try:
+        c = get_connection().cursor()
+        c.execute('SELECT chapter_number, content FROM {} WHERE base_url=? AND chapter_number BETWEEN ? AND ? ORDER BY chapter_number, fetched_at DESC'.format(CHAPTERS_TABLE), (base_url, first_chapter, last_chapter))
+        previous_number = None
+        for chapter_number, content in c:
+            if chapter_number != previous_number:
+                previous_number = chapter_number
+                yield chapter_number, decode_content(content)
+    except sqlite3.Error as error:
+        logging.error(f'Error in iter_stored_chapters: {error}')
+
+@timed
+def get_stored_chapter_numbers(base_url):
+    # Returns the set of chapter numbers of a novel present in the shared chapter store
+    try:
+        c = get_connection().cursor()
+        c.execute('SELECT DISTINCT chapter_number FROM {} WHERE base_url=?'.format(CHAPTERS_TABLE), (base_url,))
+        return {row[0] for row in c.fetchall()}
+    except sqlite3.Error as error:
+        logging.error(f'Error in get_stored_chapter_numbers: {error}')
+        return set()
+
+@timed
+def search_chapters(user_id, match, offset, limit):
+    """
+    Returns [(title, base_url, chapter number, url, snippet)] of the chapters of the user's library matching the FTS5
+    query (match), best match first. Matches in snippets are delimited by search.MATCH_START and search.MATCH_END.
+    """
+    try:
+        c = get_connection().cursor()
+        # The index is searched first, then its matches are restricted to the user's novels
+        c.execute(
+            '''SELECT l.title, {0}.base_url, {0}.chapter_number, {0}.url, snippet({0}, 0, ?, ?, '…', ?)
+                FROM {0} CROSS JOIN {1} l ON l.user_id=? AND l.base_url={0}.base_url
+                WHERE {0} MATCH ? ORDER BY {0}.rank LIMIT ? OFFSET ?'''.format(SEARCH_TABLE, LIBRARY_TABLE),
+            (MATCH_START, MATCH_END, SNIPPET_TOKENS, user_id, match, limit, offset))
+        return c.fetchall()
+    except sqlite3.Error as error:
+        logging.error(f'Error in search_chapters: {error}')
+
+NovelCheck = namedtuple('NovelCheck', ['base_url', 'last_chapter', 'etag', 'last_modified', 'listed'])
+
+@timed
+def claim_novel_checks(status, before, now, limit):
+    """
+    Returns the NovelCheck of at most (limit) novels read with (status) that weren't checked since (before), least recently checked first,
+    and marks them checked at (now) in the same transaction so that no other checker claims them.
+    (last_chapter) is the highest of the readers' total chapters and the last chapter found by earlier checks.
+    """
+    conn = get_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
         c = conn.cursor()
-        c.execute('UPDATE {} SET {}_chapter=?, {}_url=?, {}_content=? WHERE user_id=? AND base_url=?'.format(LIBRARY_TABLE, case, case, case), (chapter_number, url, content, user_id, base_url, ))
+        c.execute(
+            '''SELECT l.base_url, MAX(l.total_chapters), n.last_chapter, n.etag, n.last_modified, n.listed
+                FROM {0} l LEFT JOIN {1} n ON n.base_url=l.base_url
+                WHERE l.status=? AND COALESCE(n.checked_at, 0) <= ?
+                GROUP BY l.base_url ORDER BY COALESCE(n.checked_at, 0) LIMIT ?'''.format(LIBRARY_TABLE, CHECKS_TABLE), (status, before, limit))
+        checks = [NovelCheck(base_url, max(total_chapters or 0, last_chapter or 0), etag, last_modified, bool(listed))
+            for base_url, total_chapters, last_chapter, etag, last_modified, listed in c.fetchall()]
+        c.executemany('INSERT INTO {} (base_url, checked_at) VALUES (?, ?) ON CONFLICT(base_url) DO UPDATE SET checked_at=excluded.checked_at'.format(CHECKS_TABLE),
+            [(check.base_url, now) for check in checks])
         conn.commit()
+        return checks
     except sqlite3.Error as error:
-        if conn:
-            conn.rollback()
-        logging.error(f'Error in update_chapter_content: {error}')
-    finally:
-        if conn:
-            conn.close()
+        conn.rollback()
+        logging.error(f'Error in claim_novel_checks: {error}')
+        return []
 
-def move_chapter(user_id, url, case1, case2):
+@timed
+def record_novel_checks(status, checks):
     """
-    This function updates the chapter number, url, and content of case2 > case1
-    Used to move chapter data (e.g. from case2: 'previous' to case1: 'current')
+    Stores the NovelCheck results of a round of checks and raises the total chapters of every reader of the novels with (status)
+    to their last chapter, in one transaction.
+    Returns [(user_id, base_url, current chapter, previous total chapters, total chapters)] of the readers whose total was raised.
     """
-    conn = None
+    conn = get_connection()
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        conn.execute('BEGIN TRANSACTION')
+        conn.execute('BEGIN IMMEDIATE')
         c = conn.cursor()
-        c.execute('UPDATE {} SET {}_chapter={}_chapter, {}_url={}_url, {}_content={}_content WHERE user_id=? AND base_url=?'.format(LIBRARY_TABLE, case1, case2, case1, case2, case1, case2), (user_id, url, ))
+        c.executemany(
+            '''INSERT INTO {} (base_url, last_chapter, etag, last_modified, listed) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(base_url) DO UPDATE SET last_chapter=excluded.last_chapter, etag=excluded.etag, last_modified=excluded.last_modified, listed=excluded.listed'''.format(CHECKS_TABLE),
+            [(check.base_url, check.last_chapter, check.etag, check.last_modified, int(check.listed)) for check in checks])
+        updated = []
+        for check in checks:
+            c.execute('SELECT user_id, current_chapter, total_chapters FROM {} WHERE base_url=? AND status=? AND total_chapters < ?'.format(LIBRARY_TABLE), (check.base_url, status, check.last_chapter))
+            updated.extend((user_id, check.base_url, current_chapter, total_chapters, check.last_chapter) for user_id, current_chapter, total_chapters in c.fetchall())
+            c.execute('UPDATE {} SET total_chapters=? WHERE base_url=? AND status=? AND total_chapters < ?'.format(LIBRARY_TABLE), (check.last_chapter, check.base_url, status, check.last_chapter))
         conn.commit()
-        return
+        for user_id in {update[0] for update in updated}:
+            library_cache.invalidate(user_id)
+        return updated
     except sqlite3.Error as error:
-        if conn:
-            conn.rollback()
-        logging.error(f'Error in move_chapter_content: {error}')
-    finally:
-        if conn:
-            conn.close()
+        conn.rollback()
+        logging.error(f'Error in record_novel_checks: {error}')
+        return []
+
+@timed
+def start_prefetch_job(base_url, total_chapters, time):
+    conn = get_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('INSERT INTO {} (base_url, status, total_chapters, failed_chapters, started_at, updated_at) VALUES (?, ?, ?, 0, ?, ?) ON CONFLICT(base_url) DO UPDATE SET status=excluded.status, total_chapters=excluded.total_chapters, failed_chapters=0, started_at=excluded.started_at, updated_at=excluded.updated_at'.format(PREFETCH_TABLE), (base_url, 'running', total_chapters, time, time))
+        conn.commit()
+    except sqlite3.Error as error:
+        conn.rollback()
+        logging.error(f'Error in start_prefetch_job: {error}')
+
+@timed
+def finish_prefetch_job(base_url, failed_chapters, time):
+    # A job with failed chapters is 'incomplete' and is resumed by starting it again
+    conn = get_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('UPDATE {} SET status=?, failed_chapters=?, updated_at=? WHERE base_url=?'.format(PREFETCH_TABLE), ('complete' if failed_chapters == 0 else 'incomplete', failed_chapters, time, base_url))
+        conn.commit()
+    except sqlite3.Error as error:
+        conn.rollback()
+        logging.error(f'Error in finish_prefetch_job: {error}')
 
-def update_read_history(user_id, base_url, time):
-    conn = None
+@timed
+def get_prefetch_progress(base_url):
+    # Returns (status, total chapters, downloaded chapters, failed chapters), or None when no job was started
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        conn.execute('BEGIN TRANSACTION')
+        c = get_connection().cursor()
+        c.execute(
+            '''SELECT j.status, j.total_chapters,
+                (SELECT COUNT(DISTINCT chapter_number) FROM {1} WHERE base_url=j.base_url AND chapter_number BETWEEN 1 AND j.total_chapters),
+                j.failed_chapters
+            FROM {0} j WHERE j.base_url=?'''.format(PREFETCH_TABLE, CHAPTERS_TABLE), (base_url,))
+        return c.fetchone()
+    except sqlite3.Error as error:
+        logging.error(f'Error in get_prefetch_progress: {error}')
+
+@timed
+def update_chapter_content(user_id, base_url, chapter_number, url, content):
+    # Adds chapter (chapter_number) at (url) to the reader's window if it is still within the read-ahead window
+    # Content is written to the shared chapter store; None leaves the store untouched
+    conn = get_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        _update_chapter_content(conn.cursor(), user_id, base_url, chapter_number, url, content)
+        conn.commit()
+        chapter_cache.put(url, content)
+    except sqlite3.Error as error:
+        conn.rollback()
+        logging.error(f'Error in update_chapter_content: {error}')
+
+def _store_chapter(c, url, base_url, chapter_number, content):
+    c.execute('INSERT INTO {} (url, base_url, chapter_number, content, fetched_at) VALUES (?, ?, ?, ?, ?) ON CONFLICT(url) DO UPDATE SET content=excluded.content, fetched_at=excluded.fetched_at'.format(CHAPTERS_TABLE), (url, base_url, chapter_number, encode_content(content), datetime.now().isoformat()))
+    # Read back rather than with RETURNING, which needs SQLite 3.35
+    rowid = c.execute('SELECT rowid FROM {} WHERE url=?'.format(CHAPTERS_TABLE), (url,)).fetchone()[0]
+    # The search entry of a chapter shares its rowid, storing the chapter again replaces it
+    c.execute('DELETE FROM {} WHERE rowid=?'.format(SEARCH_TABLE), (rowid,))
+    c.execute('INSERT INTO {} (rowid, text, base_url, chapter_number, url) VALUES (?, ?, ?, ?, ?)'.format(SEARCH_TABLE), (rowid, chapter_text(content), base_url, chapter_number, url))
+
+def _update_chapter_content(c, user_id, base_url, chapter_number, url, content):
+    if content is not None:
+        _store_chapter(c, url, base_url, chapter_number, content)
+    # Preloads finishing after the reader moved on must not grow the window again, a position not flushed yet counts
+    pending = reader_updates.get((user_id, base_url))
+    position = pending.chapter_number if pending is not None else None
+    c.execute(
+        '''INSERT OR REPLACE INTO {0} (user_id, base_url, chapter_number, url)
+            SELECT user_id, base_url, ?, ? FROM {1} WHERE user_id=? AND base_url=? AND ? BETWEEN COALESCE(?, current_chapter) - ? AND COALESCE(?, current_chapter) + ?'''.format(WINDOW_TABLE, LIBRARY_TABLE),
+        (chapter_number, url, user_id, base_url, chapter_number, position, READ_BEHIND, position, READ_AHEAD))
+
+def _move_to_chapter(c, user_id, base_url, chapter_number, url):
+    # The reader's position is a single pointer, chapters that fall out of the window are dropped in the same transaction
+    c.execute('UPDATE {} SET current_chapter=?, current_url=? WHERE user_id=? AND base_url=?'.format(LIBRARY_TABLE), (chapter_number, url, user_id, base_url))
+    c.execute('DELETE FROM {} WHERE user_id=? AND base_url=? AND chapter_number NOT BETWEEN ? AND ?'.format(WINDOW_TABLE), (user_id, base_url, chapter_number - READ_BEHIND, chapter_number + READ_AHEAD))
+
+def _update_read_history(c, user_id, base_url, time):
+    # Returns False when the novel was read more recently, e.g. in a request served by another process
+    c.execute('UPDATE {} SET time=? WHERE user_id=? AND base_url=? AND (time IS NULL OR time <= ?)'.format(LIBRARY_TABLE), (time, user_id, base_url, time))
+    return c.rowcount > 0
+
+# Position and read history of a novel waiting in the write-behind buffer, (chapter_number) and (url) are None when only the time changed
+PendingRead = namedtuple('PendingRead', ['time', 'chapter_number', 'url'])
+
+def _merge_reads(pending, update):
+    if pending is None:
+        return update
+    if update.chapter_number is None:
+        return PendingRead(update.time or pending.time, pending.chapter_number, pending.url)
+    return PendingRead(update.time or pending.time, update.chapter_number, update.url)
+
+def _apply_read(c, user_id, base_url, read):
+    # A read older than the stored one, flushed late by another process, doesn't move the reader back
+    if read.time is not None and not _update_read_history(c, user_id, base_url, read.time):
+        return
+    if read.chapter_number is not None:
+        _move_to_chapter(c, user_id, base_url, read.chapter_number, read.url)
+
+@timed
+def flush_reader_updates(reads):
+    # Applies buffered {(user_id, base_url): PendingRead} in one transaction
+    conn = get_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
         c = conn.cursor()
-        c.execute('UPDATE {} SET time=? WHERE user_id=? AND base_url=?'.format(LIBRARY_TABLE), (time, user_id, base_url))
+        for (user_id, base_url), read in reads.items():
+            _apply_read(c, user_id, base_url, read)
         conn.commit()
+        return True
     except sqlite3.Error as error:
-        if conn:
+        conn.rollback()
+        logging.error(f'Error in flush_reader_updates: {error}')
+        return False
+
+reader_updates = WriteBehindBuffer(flush_reader_updates, _merge_reads, READER_FLUSH_INTERVAL, READER_BUFFER_MAX)
+
+def _pending_reads(user_id):
+    return {base_url: read for (pending_user, base_url), read in reader_updates.items() if pending_user == user_id}
+
+def _merge_pending_reads(c, user_id, rows, pending, cursor=None):
+    """
+    Returns library (rows) ending with (base_url, time) columns, with the (pending) reads of the user applied, ordered by most recently read.
+    Novels read since the last flush move up to their new place, those that moved up before (cursor) are left to the previous pages.
+    """
+    c.execute('SELECT title, current_chapter, total_chapters, status, current_url, base_url, time FROM {} WHERE user_id=? AND base_url IN ({})'.format(LIBRARY_TABLE, ', '.join('?' * len(pending))), (user_id, *pending))
+    read_rows = []
+    for title, current_chapter, total_chapters, status, current_url, base_url, time in c.fetchall():
+        read = pending[base_url]
+        if read.chapter_number is not None:
+            current_chapter, current_url = read.chapter_number, read.url
+        time = max(time or '', read.time or '')
+        if cursor is None or (time, base_url) < tuple(cursor):
+            read_rows.append((title, current_chapter, total_chapters, status, current_url, base_url, time))
+    rows = [row for row in rows if row[5] not in pending] + read_rows
+    return sorted(rows, key=lambda row: (row[6] or '', row[5]), reverse=True)
+
+ReaderState = namedtuple('ReaderState', [
+    'title',
+    'current_chapter',
+    'current_url',
+    'total_chapters',
+    'window',           # chapter number > url of every chapter in the read-ahead window
+    'chapter_number',   # chapter number of the requested url, None when it is neither in the window, the current chapter, a stored nor an indexed chapter of the novel
+    'content'           # stored content of the requested url
+    ])
+
+@timed
+def get_reader_state(user_id, base_url, url=None, load_content=True, url_chapter_number=None):
+    """
+    Returns the ReaderState of a novel in one query, or None when the novel isn't in the user's library.
+    Only the content of the requested (url) is read, and only when (load_content) is set and the chapter cache doesn't hold it.
+    A position waiting in the write-behind buffer replaces the stored one.
+    Urls that redirect to a chapter stored at its canonical url, e.g. the link a novel was added with, are resolved through the
+    chapter index, or through (url_chapter_number), the chapter number the url names, when it is the current or a window chapter.
+    Their content isn't read, callers find it in the chapter store.
+    """
+    cached_content = chapter_cache.get(url) if load_content and url is not None else None
+    pending = reader_updates.get((user_id, base_url))
+    pending_url = pending.url if pending is not None else None
+    try:
+        c = get_connection().cursor()
+        c.execute(
+            '''SELECT l.title, l.current_chapter, l.current_url, l.total_chapters, w.chapter_number, w.url,
+                CASE WHEN w.url = :content_url THEN (SELECT content FROM {2} WHERE url=w.url) END,
+                CASE WHEN COALESCE(:pending_url, l.current_url) = :content_url AND NOT EXISTS (SELECT 1 FROM {1} WHERE user_id=l.user_id AND base_url=l.base_url AND url=:url)
+                    THEN (SELECT content FROM {2} WHERE url=:content_url) END
+            FROM {0} l LEFT JOIN {1} w ON w.user_id=l.user_id AND w.base_url=l.base_url
+            WHERE l.user_id=:user_id AND l.base_url=:base_url
+            ORDER BY w.chapter_number'''.format(LIBRARY_TABLE, WINDOW_TABLE, CHAPTERS_TABLE), {'url': url, 'content_url': url if load_content and cached_content is None else None, 'pending_url': pending_url, 'user_id': user_id, 'base_url': base_url})
+        rows = c.fetchall()
+    except sqlite3.Error as error:
+        logging.error(f'Error in get_reader_state: {error}')
+        return None
+    if not rows:
+        return None
+    title, current_chapter, current_url, total_chapters = rows[0][:4]
+    if pending_url is not None:
+        current_chapter, current_url = pending.chapter_number, pending_url
+    window = {}
+    chapter_number, content = None, None
+    for _, _, _, _, window_chapter, window_url, window_content, _ in rows:
+        if window_chapter is None:
+            continue
+        window[window_chapter] = window_url
+        if window_url == url:
+            chapter_number, content = window_chapter, window_content
+    if chapter_number is None and url is not None and url == current_url:
+        chapter_number, content = current_chapter, rows[0][7]
+    if chapter_number is None and url is not None:
+        # A stored chapter outside the window, e.g. opened from search results, is jumped to
+        try:
+            c.execute('SELECT chapter_number, CASE WHEN url = ? THEN content END FROM {} WHERE url=? AND base_url=?'.format(CHAPTERS_TABLE), (url if load_content and cached_content is None else None, url, base_url))
+            chapter_number, content = c.fetchone() or (None, None)
+            if chapter_number is None:
+                c.execute('SELECT chapter_number FROM {} WHERE base_url=? AND url=?'.format(INDEX_TABLE), (base_url, url))
+                indexed_chapter = c.fetchone()
+                if indexed_chapter is not None:
+                    chapter_number = indexed_chapter[0]
+                elif url_chapter_number is not None and (url_chapter_number == current_chapter or url_chapter_number in window):
+                    chapter_number = url_chapter_number
+        except sqlite3.Error as error:
+            logging.error(f'Error in get_reader_state: {error}')
+            return None
+    if chapter_number is None:
+        return ReaderState(title, current_chapter, current_url, total_chapters, window, None, None)
+    if cached_content is not None:
+        return ReaderState(title, current_chapter, current_url, total_chapters, window, chapter_number, cached_content)
+    content = decode_content(content)
+    if load_content:
+        chapter_cache.put(url, content)
+    return ReaderState(title, current_chapter, current_url, total_chapters, window, chapter_number, content)
+
+class ReaderUpdate:
+    """
+    Unit of work for one novel of one user.
+    Chapter content updates are applied in one transaction by commit(). The position pointer move and the read history timestamp
+    go to the write-behind buffer first, so that a page turn to a preloaded chapter doesn't write at all.
+    """
+    def __init__(self, user_id, base_url):
+        self.user_id = user_id
+        self.base_url = base_url
+        self.operations = []
+        self.stored_chapters = []       # (url, content) written through to the chapter cache once committed
+        self.read = None                # PendingRead of the position and read history
+
+    def update_chapter_content(self, chapter_number, url, content):
+        self.operations.append((_update_chapter_content, (chapter_number, url, content)))
+        self.stored_chapters.append((url, content))
+
+    def move_to_chapter(self, chapter_number, url):
+        self.read = _merge_reads(self.read, PendingRead(None, chapter_number, url))
+
+    def update_read_history(self, time):
+        self.read = _merge_reads(self.read, PendingRead(time, None, None))
+
+    @timed
+    def commit(self):
+        if self.read is not None:
+            # Buffered before the content is written, whose window check needs the new position
+            reader_updates.put((self.user_id, self.base_url), self.read)
+            # Position and read history are part of the library listing, which merges pending reads: its cached renderings
+            # are invalidated as soon as a read is buffered, not when it is flushed
+            library_cache.invalidate(self.user_id)
+            self.read = None
+        if not self.operations:
+            return
+        conn = get_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            c = conn.cursor()
+            for operation, args in self.operations:
+                operation(c, self.user_id, self.base_url, *args)
+            conn.commit()
+            for url, content in self.stored_chapters:
+                chapter_cache.put(url, content)
+        except sqlite3.Error as error:
             conn.rollback()
-        logging.log(f'Error in update_read_history: {error}')
-    finally:
-        if conn:
-            conn.close()
+            logging.error(f'Error in ReaderUpdate.commit: {error}')
+        finally:
+            self.operations = []
+            self.stored_chapters = []
 
+@timed
 def get_display_preferences(user_id):
-    conn = None
+    # Returns (mode, font, font_size), served from the preferences cache when possible
+    preferences = preferences_cache.get(user_id)
+    if preferences is not None:
+        return preferences
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        c = conn.cursor()
+        c = get_connection().cursor()
         c.execute('SELECT mode, font, font_size FROM {} WHERE user_id=?'.format(DISPLAY_TABLE), (user_id, ))
         result = c.fetchone()
-        conn.commit()
         if result:
-            return result[0], result[1], result[2]
+            preferences = result[0], result[1], result[2]
         else:
-            return "light", "Arial", 16 
+            preferences = "light", "Arial", 16
+        preferences_cache.put(user_id, preferences)
+        return preferences
     except sqlite3.Error as error:
-        logging.log(f'Error in get_display_preferences: {error}')
-    finally:
-        if conn:
-            conn.close()
+        logging.error(f'Error in get_display_preferences: {error}')
 
+@timed
 def update_display_preferences(user_id, mode, font, font_size):
-    conn = None
+    conn = get_connection()
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        conn.execute('BEGIN TRANSACTION')
+        conn.execute('BEGIN IMMEDIATE')
         c = conn.cursor()
         c.execute('INSERT OR REPLACE INTO {} (user_id, mode, font, font_size) VALUES (?, ?, ?, ?)'.format(DISPLAY_TABLE), (user_id, mode, font, font_size))
         conn.commit()
+        preferences_cache.invalidate(user_id)
     except sqlite3.Error as error:
-        if conn:
-            conn.rollback()
-        logging.log(f'Error in update_display_preferences: {error}')
-    finally:
-        if conn:
-            conn.close()
\ No newline at end of file
+        conn.rollback()
+        logging.error(f'Error in update_display_preferences: {error}')
+
+"""
+Durable job queue
+Jobs are leased by worker processes (see worker.py): a lease expires after a while so that jobs of a crashed worker run again.
+Jobs with equal (job_key) are coalesced, (scope) groups jobs cancelled together. (args) and (result) are stored as JSON.
+Times are UNIX timestamps. (finished_seq) numbers finished jobs in completion order so that the web process can follow them.
+"""
+
+Job = namedtuple('Job', ['id', 'kind', 'args', 'attempts'])
+
+@timed
+def enqueue_job(job_key, kind, scope, args, priority, now):
+    """
+    Queues a job, or requeues a finished or cancelled job with the same key. Lower (priority) runs first.
+    Returns False when a job with the same key is already leased, the running job is then kept.
+    """
+    conn = get_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        c = conn.execute(
+            '''INSERT INTO {} (job_key, kind, scope, args, priority, status, attempts, available_at, enqueued_at) VALUES (?, ?, ?, ?, ?, 'queued', 0, ?, ?)
+                ON CONFLICT(job_key) DO UPDATE SET scope=excluded.scope, args=excluded.args, priority=excluded.priority, status='queued', attempts=0,
+                    available_at=excluded.available_at, enqueued_at=excluded.enqueued_at, lease_owner=NULL, lease_expires_at=NULL, result=NULL, error=NULL
+                WHERE status != 'leased' '''.format(JOBS_TABLE),
+            (job_key, kind, scope, json.dumps(args), priority, now, now))
+        conn.commit()
+        return c.rowcount > 0
+    except sqlite3.Error as error:
+        conn.rollback()
+        logging.error(f'Error in enqueue_job: {error}')
+        return False
+
+@timed
+def cancel_jobs(scope):
+    # Cancels the queued jobs of a scope, leased jobs run to completion
+    conn = get_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute("UPDATE {} SET status='cancelled' WHERE scope=? AND status='queued'".format(JOBS_TABLE), (scope,))
+        conn.commit()
+    except sqlite3.Error as error:
+        conn.rollback()
+        logging.error(f'Error in cancel_jobs: {error}')
+
+@timed
+def lease_job(owner, lease_seconds, now):
+    # Leases the next runnable job to (owner) and returns it as a Job, or None when there is none
+    # Jobs whose lease expired are runnable again
+    conn = get_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        c = conn.cursor()
+        c.execute(
+            '''SELECT id, kind, args, attempts FROM {} WHERE (status='queued' AND available_at <= :now) OR (status='leased' AND lease_expires_at < :now)
+                ORDER BY priority, id LIMIT 1'''.format(JOBS_TABLE), {'now': now})
+        row = c.fetchone()
+        if row is None:
+            conn.commit()
+            return None
+        c.execute("UPDATE {} SET status='leased', lease_owner=?, lease_expires_at=?, attempts=attempts + 1 WHERE id=?".format(JOBS_TABLE), (owner, now + lease_seconds, row[0]))
+        conn.commit()
+        return Job(row[0], row[1], json.loads(row[2]), row[3] + 1)
+    except sqlite3.Error as error:
+        conn.rollback()
+        logging.error(f'Error in lease_job: {error}')
+
+@timed
+def finish_job(job_id, owner, status, result, error_message, now):
+    # Records the outcome ('done' or 'failed') of a job still leased by (owner)
+    conn = get_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute(
+            '''UPDATE {0} SET status=?, result=?, error=?, finished_at=?, lease_owner=NULL, lease_expires_at=NULL,
+                finished_seq=(SELECT COALESCE(MAX(finished_seq), 0) + 1 FROM {0})
+                WHERE id=? AND lease_owner=? AND status='leased' '''.format(JOBS_TABLE),
+            (status, None if result is None else json.dumps(result), error_message, now, job_id, owner))
+        conn.commit()
+    except sqlite3.Error as error:
+        conn.rollback()
+        logging.error(f'Error in finish_job: {error}')
+
+@timed
+def retry_job(job_id, owner, available_at, error_message):
+    # Returns a job still leased by (owner) to the queue, runnable again from (available_at)
+    conn = get_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute(
+            "UPDATE {} SET status='queued', available_at=?, error=?, lease_owner=NULL, lease_expires_at=NULL WHERE id=? AND lease_owner=? AND status='leased'".format(JOBS_TABLE),
+            (available_at, error_message, job_id, owner))
+        conn.commit()
+    except sqlite3.Error as error:
+        conn.rollback()
+        logging.error(f'Error in retry_job: {error}')
+
+@timed
+def get_job_status(job_key):
+    # Returns (status, result, error) of a job, or None
+    try:
+        c = get_connection().cursor()
+        c.execute('SELECT status, result, error FROM {} WHERE job_key=?'.format(JOBS_TABLE), (job_key,))
+        row = c.fetchone()
+        return None if row is None else (row[0], None if row[1] is None else json.loads(row[1]), row[2])
+    except sqlite3.Error as error:
+        logging.error(f'Error in get_job_status: {error}')
+
+@timed
+def get_finished_jobs(after_seq, limit):
+    # Returns [(finished_seq, kind, args, status, result)] of the jobs finished after (after_seq), in completion order
+    try:
+        c = get_connection().cursor()
+        c.execute('SELECT finished_seq, kind, args, status, result FROM {} WHERE finished_seq > ? ORDER BY finished_seq LIMIT ?'.format(JOBS_TABLE), (after_seq, limit))
+        return [(seq, kind, json.loads(args), status, None if result is None else json.loads(result)) for seq, kind, args, status, result in c.fetchall()]
+    except sqlite3.Error as error:
+        logging.error(f'Error in get_finished_jobs: {error}')
+        return []
+
+@timed
+def get_last_finished_seq():
+    try:
+        c = get_connection().cursor()
+        c.execute('SELECT COALESCE(MAX(finished_seq), 0) FROM {}'.format(JOBS_TABLE))
+        return c.fetchone()[0]
+    except sqlite3.Error as error:
+        logging.error(f'Error in get_last_finished_seq: {error}')
+        return 0
+
+@timed
+def count_jobs(scope=None):
+    # Returns {status: number of jobs}, of one scope or of the whole queue
+    try:
+        c = get_connection().cursor()
+        if scope is None:
+            c.execute('SELECT status, COUNT(*) FROM {} GROUP BY status'.format(JOBS_TABLE))
+        else:
+            c.execute('SELECT status, COUNT(*) FROM {} WHERE scope=? GROUP BY status'.format(JOBS_TABLE), (scope,))
+        return dict(c.fetchall())
+    except sqlite3.Error as error:
+        logging.error(f'Error in count_jobs: {error}')
+        return {}
+
+@timed
+def purge_jobs(before):
+    # Deletes jobs that finished or were cancelled before (before)
+    # The job holding the last finished_seq is kept, so that the sequence never restarts below what job watchers have seen
+    conn = get_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute(
+            '''DELETE FROM {0} WHERE status IN ('done', 'failed', 'cancelled') AND COALESCE(finished_at, enqueued_at) < ?
+                AND (finished_seq IS NULL OR finished_seq < (SELECT MAX(finished_seq) FROM {0}))'''.format(JOBS_TABLE), (before,))
+        conn.commit()
+    except sqlite3.Error as error:
+        conn.rollback()
+        logging.error(f'Error in purge_jobs: {error}')
@@ -0,0 +1,46 @@
+import os
+import queue
+import threading
+
+SSE_KEEPALIVE = float(os.getenv('SSE_KEEPALIVE', 15))
+# Seconds a client stays on one event stream before it is ended, browsers reconnect after the stream's retry delay
+SSE_MAX_DURATION = float(os.getenv('SSE_MAX_DURATION', 300))
+SUBSCRIBER_QUEUE_SIZE = 100
+
+class EventBroker:
+    """
+    In-process publish/subscribe of preload events.
+    Each subscriber owns a bounded queue; events for a subscriber that stopped reading are dropped rather than buffered.
+    """
+    def __init__(self):
+        self._subscribers = {}      # topic > set of subscriber queues
+        self._lock = threading.Lock()
+
+    def subscribe(self, topic):
+        subscription = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, topic, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(topic)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[topic]
+
+    def publish(self, topic, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(topic, ()))
+        for subscription in subscribers:
+            try:
+                subscription.put_nowait(event)
+            except queue.Full:
+                pass
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+event_broker = EventBroker()
@@ -0,0 +1,90 @@
+import re
+import html
+import zipfile
+
+"""
+Streamed novel exports
+Chapters are written one at a time into a zip archive whose output is handed to the caller as soon as each
+chapter is compressed, so a whole book is never held in memory. (chapters) is an iterable of (chapter number, content)
+in reading order, where content is in the reader view format: <p>...</p> paragraphs of escaped text.
+"""
+
+PARAGRAPH = re.compile(r'<p>(.*?)</p>', re.DOTALL)
+
+class StreamBuffer:
+    # Write-only file object collecting zip output until the generator hands it to the client
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def paragraphs_to_xhtml(content):
+    # Reader view paragraphs hold escaped text, unescaped and escaped again so that only XML entities remain and the chapter is well-formed XHTML
+    return '\n'.join(f'<p>{html.escape(html.unescape(paragraph))}</p>' for paragraph in PARAGRAPH.findall(content or ''))
+
+def chapter_document(title, body):
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<!DOCTYPE html>\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">\n'
+        f'<head><meta charset="utf-8"/><title>{html.escape(title)}</title></head>\n'
+        f'<body><h1>{html.escape(title)}</h1>\n{body}\n</body>\n</html>\n')
+
+def stream_epub(title, identifier, chapters):
+    """
+    Yields an EPUB 3 book. Chapters are written first and the package document and navigation,
+    which only need the chapter numbers, are written last.
+    """
+    buffer = StreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as book:
+        # The mimetype entry must come first and uncompressed
+        book.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        book.writestr('META-INF/container.xml',
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">\n'
+            '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>\n'
+            '</container>\n')
+        chapter_numbers = []
+        for chapter_number, content in chapters:
+            book.writestr(f'OEBPS/chapter-{chapter_number}.xhtml', chapter_document(f'Chapter {chapter_number}', paragraphs_to_xhtml(content)))
+            chapter_numbers.append(chapter_number)
+            yield buffer.drain()
+        manifest = '\n'.join(f'<item id="chapter-{number}" href="chapter-{number}.xhtml" media-type="application/xhtml+xml"/>' for number in chapter_numbers)
+        spine = '\n'.join(f'<itemref idref="chapter-{number}"/>' for number in chapter_numbers)
+        book.writestr('OEBPS/content.opf',
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="book-id">\n'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">\n'
+            f'<dc:identifier id="book-id">{html.escape(identifier)}</dc:identifier>\n'
+            f'<dc:title>{html.escape(title)}</dc:title>\n'
+            '<dc:language>en</dc:language>\n'
+            '</metadata>\n'
+            f'<manifest>\n<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>\n{manifest}\n</manifest>\n'
+            f'<spine>\n{spine}\n</spine>\n'
+            '</package>\n')
+        toc = '\n'.join(f'<li><a href="chapter-{number}.xhtml">Chapter {number}</a></li>' for number in chapter_numbers)
+        book.writestr('OEBPS/nav.xhtml', chapter_document(title, f'<nav epub:type="toc"><ol>\n{toc}\n</ol></nav>'))
+    yield buffer.drain()
+
+def stream_html_zip(title, chapters):
+    # Yields a zip of one HTML page per chapter and an index page linking them
+    buffer = StreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as bundle:
+        chapter_numbers = []
+        for chapter_number, content in chapters:
+            bundle.writestr(f'chapter-{chapter_number}.html', chapter_document(f'Chapter {chapter_number}', paragraphs_to_xhtml(content)))
+            chapter_numbers.append(chapter_number)
+            yield buffer.drain()
+        toc = '\n'.join(f'<li><a href="chapter-{number}.html">Chapter {number}</a></li>' for number in chapter_numbers)
+        bundle.writestr('index.html', chapter_document(title, f'<ol>\n{toc}\n</ol>'))
+    yield buffer.drain()
@@ -0,0 +1,227 @@
+import os
+import re
+import html
+import logging
+import urllib.error
+import urllib.parse
+import urllib.request
+from html.parser import HTMLParser
+
+from metrics import timed
+from hosts import host_limiter
+
+# Chapter extraction backend:
+#   'auto'     - plain HTTP fetch, falls back to Selenium reader view when no paragraphs are found
+#   'http'     - plain HTTP fetch only
+#   'selenium' - Selenium reader view only
+EXTRACTOR_BACKEND = os.getenv('EXTRACTOR_BACKEND', 'auto')
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', 10))
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0'
+
+# Elements whose text is never chapter content
+SKIPPED_TAGS = {'script', 'style', 'noscript', 'template', 'svg', 'head', 'nav', 'header', 'footer', 'aside', 'form', 'button', 'select'}
+# Class/id fragments marking boilerplate containers (comments, menus, ads...)
+UNLIKELY_CANDIDATES = re.compile(r'comment|share|social|sidebar|menu|nav|footer|header|\bads?\b|advert|sponsor|related|popup|breadcrumb', re.IGNORECASE)
+LIKELY_CANDIDATES = re.compile(r'chapter|content|article|text|body|entry|main|story|reader', re.IGNORECASE)
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+
+@timed
+def fetch(url):
+    # Returns (final url after redirects, decoded html) of given url
+    request = urllib.request.Request(url, headers={'User-Agent': USER_AGENT, 'Accept': 'text/html,application/xhtml+xml'})
+    with host_limiter.request(url), urllib.request.urlopen(request, timeout=HTTP_TIMEOUT) as response:
+        charset = response.headers.get_content_charset() or 'utf-8'
+        return response.geturl(), response.read().decode(charset, errors='replace')
+
+@timed
+def fetch_if_modified(url, etag=None, last_modified=None):
+    """
+    Conditional fetch: returns (final url after redirects, decoded html, etag, last modified) of given url.
+    html is None when the server answers 304 Not Modified to the (etag) and (last_modified) of an earlier fetch.
+    """
+    headers = {'User-Agent': USER_AGENT, 'Accept': 'text/html,application/xhtml+xml'}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    try:
+        with host_limiter.request(url), urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=HTTP_TIMEOUT) as response:
+            charset = response.headers.get_content_charset() or 'utf-8'
+            html = response.read().decode(charset, errors='replace')
+            return response.geturl(), html, response.headers.get('ETag'), response.headers.get('Last-Modified')
+    except urllib.error.HTTPError as error:
+        if error.code == 304:
+            return url, None, etag, last_modified
+        raise
+
+class HeadRedirectHandler(urllib.request.HTTPRedirectHandler):
+    # Follows redirects of HEAD requests with HEAD requests, urllib turns them into GET requests otherwise
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        request = super().redirect_request(req, fp, code, msg, headers, newurl)
+        if request is not None and req.get_method() == 'HEAD':
+            request.method = 'HEAD'
+        return request
+
+head_opener = urllib.request.build_opener(HeadRedirectHandler)
+
+@timed
+def probe(url):
+    """
+    Returns the final url after redirects of given url without downloading the page, or None when it doesn't exist (4xx but 429).
+    Servers refusing HEAD requests are probed with a GET whose body isn't read.
+    """
+    headers = {'User-Agent': USER_AGENT}
+    try:
+        with host_limiter.request(url), head_opener.open(urllib.request.Request(url, headers=headers, method='HEAD'), timeout=HTTP_TIMEOUT) as response:
+            return response.geturl()
+    except urllib.error.HTTPError as error:
+        if error.code not in (405, 501):
+            if 400 <= error.code < 500 and error.code != 429:
+                return None
+            raise
+    try:
+        with host_limiter.request(url), urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=HTTP_TIMEOUT) as response:
+            return response.geturl()
+    except urllib.error.HTTPError as error:
+        if 400 <= error.code < 500 and error.code != 429:
+            return None
+        raise
+
+class ParagraphParser(HTMLParser):
+    """
+    Collects the text of every <p> element together with the container element it sits in.
+    Paragraphs inside skipped tags or boilerplate containers are ignored.
+    """
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.stack = []             # open elements as (tag, serial number, is skipped)
+        self.paragraphs = []        # (container serial number, text)
+        self.current = None
+        self.serial = 0
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_TAGS:
+            if tag == 'br' and self.current is not None:
+                self.current.append(' ')
+            return
+        attributes = dict(attrs)
+        marker = f"{attributes.get('class') or ''} {attributes.get('id') or ''}"
+        skipped = tag in SKIPPED_TAGS or (bool(UNLIKELY_CANDIDATES.search(marker)) and not LIKELY_CANDIDATES.search(marker))
+        if skipped:
+            self.skip_depth += 1
+        self.serial += 1
+        self.stack.append((tag, self.serial, skipped))
+        if tag == 'p':
+            self._close_paragraph()
+            self.current = []
+
+    def handle_endtag(self, tag):
+        if not any(open_tag == tag for open_tag, _, _ in self.stack):
+            return
+        while self.stack:
+            open_tag, _, skipped = self.stack.pop()
+            if skipped:
+                self.skip_depth -= 1
+            if open_tag == 'p':
+                self._close_paragraph()
+            if open_tag == tag:
+                return
+
+    def handle_data(self, data):
+        if self.current is not None:
+            self.current.append(data)
+
+    def close(self):
+        super().close()
+        self._close_paragraph()
+
+    def _close_paragraph(self):
+        if self.current is None:
+            return
+        text = ' '.join(''.join(self.current).split())
+        if text and self.skip_depth == 0:
+            # Innermost open element that is not itself a paragraph
+            container = next((serial for tag, serial, _ in reversed(self.stack) if tag != 'p'), 0)
+            self.paragraphs.append((container, text))
+        self.current = None
+
+def extract_paragraphs(html):
+    """
+    Readability-style extraction: returns the paragraphs of the container holding the most prose.
+    Each container is scored by the text length of its paragraphs, with a bonus per comma so that
+    prose outranks link lists and short labels.
+    """
+    parser = ParagraphParser()
+    parser.feed(html)
+    parser.close()
+    scores = {}
+    for container, text in parser.paragraphs:
+        scores[container] = scores.get(container, 0) + len(text) + 10 * text.count(',')
+    if not scores:
+        return []
+    best = max(scores, key=scores.get)
+    return [text for container, text in parser.paragraphs if container == best]
+
+@timed
+def get_http_chapter(url):
+    """
+    Fetches url once and returns (final url after redirects, chapter content in the reader view format).
+    Paragraphs are plain text, escaped in the <p> elements of the content like every other stored chapter.
+    Content is None when the page yielded no paragraphs, final url is None when the fetch failed.
+    """
+    final_url, paragraphs = get_http_paragraphs(url)
+    if not paragraphs:
+        return final_url, None
+    return final_url, "".join(f'<p>{html.escape(paragraph)}</p>' for paragraph in paragraphs)
+
+def get_http_paragraphs(url):
+    # Fetches url once and returns (final url after redirects, [paragraph text]), both None when the fetch failed
+    try:
+        final_url, html = fetch(url)
+    except Exception as error:
+        logging.error(f'Error in get_http_chapter: {error}')
+        return None, None
+    return final_url, extract_paragraphs(html)
+
+class LinkParser(HTMLParser):
+    # Collects the href of every anchor
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            href = dict(attrs).get('href')
+            if href:
+                self.links.append(href)
+
+def extract_chapter_links(html, page_url, base_url):
+    """
+    Table-of-contents parsing: returns {chapter number: absolute url} of the links on a page that point at chapters of
+    the novel at (base_url), i.e. '{base_url}/chapter-{n}' optionally followed by a slug.
+    """
+    parser = LinkParser()
+    parser.feed(html)
+    parser.close()
+    pattern = chapter_url_pattern(base_url)
+    chapters = {}
+    for href in parser.links:
+        url = urllib.parse.urljoin(page_url, href).split('#')[0]
+        match = pattern.match(url)
+        if match:
+            chapters.setdefault(int(match.group(1)), url)
+    return chapters
+
+def chapter_url_pattern(base_url):
+    # Matches the chapter urls of the novel at (base_url), capturing the chapter number
+    return re.compile(re.escape(base_url.rstrip('/')) + r'/chapter-(\d+)(?![\d])')
+
+def get_table_of_contents(base_url):
+    # Returns {chapter number: url} listed on the novel's main page, empty when there is none
+    try:
+        final_url, html = fetch(base_url)
+    except Exception as error:
+        logging.error(f'Error in get_table_of_contents: {error}')
+        return {}
+    return extract_chapter_links(html, final_url, base_url)
@@ -0,0 +1,209 @@
+import os
+import time
+import logging
+import threading
+import http.client
+import urllib.error
+import urllib.parse
+from contextlib import contextmanager
+
+from metrics import registry, STAGE_SECONDS
+
+"""
+Per-host politeness
+Every request to a source site, plain HTTP or through a browser, is made inside host_limiter.request(url), which
+- waits for a token of the host's bucket, refilled at the host's current rate up to HOST_BURST tokens,
+- waits for one of the host's HOST_CONCURRENCY request slots,
+- backs off when the host answers 429 or 5xx, times out or can't be reached (see is_failure): the host's rate is halved and its requests
+  fail with HostUnavailable without being sent until a cooldown ends (Retry-After when the host sends one, HOST_BACKOFF doubled per
+  consecutive failure otherwise, either at most HOST_BACKOFF_MAX), then every successful request gives back part of the rate,
+- opens the host's circuit after HOST_FAILURE_THRESHOLD consecutive failures: once the cooldown ends, a single trial request
+  closes the circuit again or reopens it.
+Nothing waits for a cooldown: available() is False during one, and callers fall back to stored chapters and indexed urls.
+Callers about to borrow a browser reserve a request slot first (see reserve), so that no browser is held while waiting for a host.
+Limits are kept per process.
+"""
+
+HOST_RATE = float(os.getenv('HOST_RATE', 2))                       # requests per second per host
+HOST_BURST = float(os.getenv('HOST_BURST', 5))
+HOST_CONCURRENCY = int(os.getenv('HOST_CONCURRENCY', 2))
+HOST_BACKOFF = float(os.getenv('HOST_BACKOFF', 5))                 # seconds of the first cooldown
+HOST_BACKOFF_MAX = float(os.getenv('HOST_BACKOFF_MAX', 600))
+HOST_FAILURE_THRESHOLD = int(os.getenv('HOST_FAILURE_THRESHOLD', 5))
+HOST_RATE_MIN = HOST_RATE / 16
+
+# Results: ok, failed (throttled, server error, timeout), rejected (circuit open)
+HOST_REQUESTS = registry.counter('novel_reader_host_requests_total', 'Requests to source sites by host and result.', ('host', 'result'))
+
+class HostUnavailable(Exception):
+    # Raised instead of sending a request to a host whose circuit is open
+    pass
+
+def is_failure(error):
+    """
+    Errors telling that the host is overloaded or unreachable: 429, 5xx but a refused HEAD (501), network errors and timeouts.
+    A missing page (4xx), an unchanged one (304) or any other error (e.g. a page without reader content) isn't the host's fault.
+    Browser errors are matched by name, so that selenium is only imported by processes that launch a browser.
+    """
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code == 429 or (error.code >= 500 and error.code != 501)
+    if isinstance(error, (OSError, http.client.HTTPException)):
+        return True
+    # Page load timeouts, and Firefox's error page for unreachable hosts
+    return type(error).__name__ == 'TimeoutException' or 'about:neterror' in str(error)
+
+def retry_after(error):
+    # Seconds of a Retry-After header, HTTP dates are ignored
+    value = error.headers.get('Retry-After') if isinstance(error, urllib.error.HTTPError) and error.headers else None
+    try:
+        return max(float(value), 0) if value is not None else None
+    except ValueError:
+        return None
+
+class HostState:
+    def __init__(self, now):
+        self.tokens = HOST_BURST
+        self.rate = HOST_RATE
+        self.refilled_at = now
+        self.in_flight = 0
+        self.failures = 0               # consecutive failures
+        self.cooldown_until = 0
+        self.circuit = 'closed'         # 'closed', 'open' or 'half_open' while the trial request runs
+        self.requests = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def refill(self, now):
+        self.tokens = min(HOST_BURST, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+
+class HostLimiter:
+    def __init__(self):
+        self._hosts = {}                # host > HostState
+        self._condition = threading.Condition()
+        self._local = threading.local()     # .reserved: host > HostState of the slot reserved by this thread
+
+    @contextmanager
+    def request(self, url):
+        host = urllib.parse.urlsplit(url).hostname or ''
+        state = self._reservations().pop(host, None)
+        if state is None:
+            with STAGE_SECONDS.time(stage='host_wait'):
+                state = self._acquire(host)
+        error = None
+        try:
+            yield
+        except BaseException as raised:
+            error = raised
+            raise
+        finally:
+            # Also released when the caller is interrupted, e.g. by GeneratorExit from an abandoned stream
+            self._release(host, state, error)
+
+    @contextmanager
+    def reserve(self, url):
+        # Takes one of the host's request slots ahead of time, the next request() to the host on this thread uses it
+        # Raises HostUnavailable like request(); a slot no request used is given back when the block exits. 
+        host = urllib.parse.urlsplit(url).hostname or ''
+        reservations = self._reservations()
+        if host in reservations:
+            yield
+            return
+        with STAGE_SECONDS.time(stage='host_wait'):
+            state = reservations[host] = self._acquire(host)
+        try:
+            yield
+        finally:
+            if reservations.get(host) is state:
+                del reservations[host]
+                self._cancel(state)
+
+    def available(self, url):
+        # False while the host is cooling down or its circuit's trial request runs, requests to it would fail with HostUnavailable
+        with self._condition:
+            state = self._hosts.get(urllib.parse.urlsplit(url).hostname or '')
+            return state is None or (state.circuit != 'half_open' and time.monotonic() >= state.cooldown_until)
+
+    def _reservations(self):
+        if not hasattr(self._local, 'reserved'):
+            self._local.reserved = {}
+        return self._local.reserved
+
+    def _acquire(self, host):
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                state = self._hosts.get(host)
+                if state is None:
+                    state = self._hosts[host] = HostState(now)
+                if state.circuit == 'open' and now >= state.cooldown_until:
+                    state.circuit = 'half_open'
+                    if state.in_flight == 0:
+                        state.in_flight += 1
+                        state.requests += 1
+                        return state
+                if state.circuit != 'closed' or now < state.cooldown_until:
+                    state.rejected += 1
+                    HOST_REQUESTS.inc(host=host, result='rejected')
+                    raise HostUnavailable(f'{host} is cooling down for {max(state.cooldown_until - now, 0):.0f}s')
+                state.refill(now)
+                wait = max((1 - state.tokens) / state.rate, 0)
+                if wait == 0 and state.in_flight < HOST_CONCURRENCY:
+                    state.tokens -= 1
+                    state.in_flight += 1
+                    state.requests += 1
+                    return state
+                # Woken early when a slot frees up or the host's state changes
+                self._condition.wait(wait or None)
+
+    def _cancel(self, state):
+        # Gives back a reserved slot and its token, the request it was reserved for wasn't sent
+        with self._condition:
+            state.in_flight -= 1
+            state.requests -= 1
+            state.tokens = min(HOST_BURST, state.tokens + 1)
+            if state.circuit == 'half_open' and state.in_flight == 0:
+                # The trial request wasn't sent, the next request is the trial
+                state.circuit = 'open'
+            self._condition.notify_all()
+
+    def _release(self, host, state, error):
+        with self._condition:
+            state.in_flight -= 1
+            if error is None or not is_failure(error):
+                HOST_REQUESTS.inc(host=host, result='ok')
+                state.failures = 0
+                state.rate = min(HOST_RATE, state.rate + HOST_RATE / 8)
+                if state.circuit == 'half_open':
+                    state.circuit = 'closed'
+                    logging.info(f'Host {host} recovered')
+            else:
+                HOST_REQUESTS.inc(host=host, result='failed')
+                state.failed += 1
+                state.failures += 1
+                state.rate = max(state.rate / 2, HOST_RATE_MIN)
+                delay = retry_after(error)
+                if delay is None:
+                    delay = HOST_BACKOFF * 2 ** (state.failures - 1)
+                delay = min(delay, HOST_BACKOFF_MAX)
+                state.cooldown_until = time.monotonic() + delay
+                if state.circuit == 'half_open' or state.failures >= HOST_FAILURE_THRESHOLD:
+                    state.circuit = 'open'
+                logging.error(f'Error in HostLimiter: {host} failed ({error}), cooling down for {delay:.1f}s')
+            self._condition.notify_all()
+
+    def stats(self):
+        # Per-host state, current rate, requests in flight and request counters
+        with self._condition:
+            now = time.monotonic()
+            return {host: {
+                'circuit': state.circuit,
+                'rate': round(state.rate, 3),
+                'in_flight': state.in_flight,
+                'cooldown': round(max(state.cooldown_until - now, 0), 1),
+                'requests': state.requests,
+                'failed': state.failed,
+                'rejected': state.rejected
+                } for host, state in self._hosts.items()}
+
+host_limiter = HostLimiter()
@@ -0,0 +1,113 @@
+import os
+import time
+import logging
+import threading
+
+from database import enqueue_job, cancel_jobs, get_job_status, get_finished_jobs, get_last_finished_seq, count_jobs
+
+"""
+Scraping jobs of the durable queue
+With PRELOAD_QUEUE='database' the web process only enqueues jobs and reads their results, scraping runs in worker
+processes (python app/worker.py) that can be scaled independently. With the default 'thread' the web process scrapes
+on its own preload scheduler and no worker is needed.
+
+Job kinds and their arguments:
+    'preload'   [user_id, base_url, chapter_number]     adds a chapter to a reader's read-ahead window
+    'prefetch'  [base_url, chapter_number]              downloads a chapter of a whole-novel download
+    'chapter'   [base_url, chapter_number, url]         extracts a chapter a reader opened that wasn't stored yet
+"""
+
+PRELOAD_QUEUE = os.getenv('PRELOAD_QUEUE', 'thread')       # 'thread' or 'database'
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 3))
+JOB_BACKOFF = float(os.getenv('JOB_BACKOFF', 5))           # seconds before the first retry, doubled for each further retry
+JOB_BACKOFF_MAX = float(os.getenv('JOB_BACKOFF_MAX', 300))
+JOB_LEASE = float(os.getenv('JOB_LEASE', 120))             # seconds before a job leased by an unresponsive worker runs again
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', 0.25))
+JOB_RETENTION = float(os.getenv('JOB_RETENTION', 86400))   # seconds finished jobs are kept
+CHAPTER_JOB_TIMEOUT = float(os.getenv('CHAPTER_JOB_TIMEOUT', 60))
+
+# Priorities, lower runs first: chapters a reader is waiting for, then preloads by distance from the reader, then downloads
+CHAPTER_PRIORITY = 0
+PREFETCH_PRIORITY = 100
+
+def preload_scope(user_id, base_url):
+    return f'preload:{user_id}:{base_url}'
+
+def prefetch_scope(base_url):
+    return f'prefetch:{base_url}'
+
+def enqueue_preload(user_id, base_url, chapter_number, priority):
+    return enqueue_job(f'preload:{user_id}:{base_url}:{chapter_number}', 'preload', preload_scope(user_id, base_url), [user_id, base_url, chapter_number], priority, time.time())
+
+def cancel_preloads(user_id, base_url):
+    cancel_jobs(preload_scope(user_id, base_url))
+
+def enqueue_prefetch(base_url, chapter_number):
+    return enqueue_job(f'prefetch:{base_url}:{chapter_number}', 'prefetch', prefetch_scope(base_url), [base_url, chapter_number], PREFETCH_PRIORITY, time.time())
+
+def is_prefetch_running(base_url):
+    counts = count_jobs(prefetch_scope(base_url))
+    return counts.get('queued', 0) + counts.get('leased', 0) > 0
+
+def retry_delay(attempts):
+    return min(JOB_BACKOFF * 2 ** (attempts - 1), JOB_BACKOFF_MAX)
+
+def run_chapter_job(base_url, chapter_number, url, timeout=CHAPTER_JOB_TIMEOUT):
+    """
+    Enqueues the extraction of a chapter ahead of every other job and waits for a worker to finish it.
+    Returns the url the chapter was stored at, its final url after redirects, or None when it failed or didn't finish within (timeout) seconds.
+    """
+    job_key = f'chapter:{url}'
+    enqueue_job(job_key, 'chapter', None, [base_url, chapter_number, url], CHAPTER_PRIORITY, time.time())
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = get_job_status(job_key)
+        if status is None or status[0] in ('failed', 'cancelled'):
+            return None
+        if status[0] == 'done':
+            return status[1]['url']
+        time.sleep(JOB_POLL_INTERVAL)
+    logging.error(f'Error in run_chapter_job: {url} not extracted within {timeout}s')
+    return None
+
+def queue_stats():
+    counts = count_jobs()
+    return {
+        'queue_depth': counts.get('queued', 0),
+        'active': counts.get('leased', 0),
+        'completed': counts.get('done', 0),
+        'failed': counts.get('failed', 0),
+        'cancelled': counts.get('cancelled', 0)
+    }
+
+class JobWatcher:
+    """
+    Follows the jobs finished by worker processes and hands finished preloads to (on_preload)(user_id, base_url, chapter_number, url).
+    Runs in the web process on one thread, started on first use; jobs finished before it started are not reported.
+    """
+    def __init__(self, on_preload, interval=JOB_POLL_INTERVAL):
+        self.on_preload = on_preload
+        self.interval = interval
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._watch, args=(get_last_finished_seq(),), name='job-watcher', daemon=True)
+                self._thread.start()
+
+    def _watch(self, last_seq, batch_size=100):
+        while True:
+            finished_jobs = []
+            try:
+                finished_jobs = get_finished_jobs(last_seq, batch_size)
+                for seq, kind, args, status, result in finished_jobs:
+                    last_seq = seq
+                    if kind == 'preload' and status == 'done' and result:
+                        user_id, base_url, chapter_number = args
+                        self.on_preload(user_id, base_url, chapter_number, result['url'])
+            except Exception as error:
+                logging.error(f'Error in JobWatcher: {error}')
+            if len(finished_jobs) < batch_size:
+                time.sleep(self.interval)
@@ -0,0 +1,177 @@
+import time
+import inspect
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+"""
+Process metrics in the Prometheus text exposition format
+Metrics are kept in memory per process and rendered by the /metrics endpoint. Counters and histograms are updated
+by the instrumented code, callback metrics read their value from another object (e.g. the preload scheduler) when rendered.
+"""
+
+# Upper bounds in seconds, from a stored chapter lookup up to a browser launch
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    # Monotonic count per label set
+    type = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}               # label values > count
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(label, '') for label in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield self.name, dict(zip(self.labels, key)), value
+
+class Histogram:
+    # Cumulative bucket counts, sum and count of observed durations per label set
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._values = {}               # label values > [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(label, '') for label in self.labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(entry[0]), entry[1], entry[2]) for key, entry in self._values.items()}
+        for key, (bucket_counts, total, count) in sorted(values.items()):
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket', {**labels, 'le': format_value(bound)}, cumulative
+            yield f'{self.name}_sum', labels, total
+            yield f'{self.name}_count', labels, count
+
+class CallbackMetric:
+    # Gauge or counter whose value is read from (function) when rendered
+    def __init__(self, name, documentation, function, type='gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.type = type
+
+    def samples(self):
+        yield self.name, {}, self.function()
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}              # name > metric, in registration order
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'Metric {metric.name} is already registered')
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def gauge_function(self, name, documentation, function):
+        return self.register(CallbackMetric(name, documentation, function))
+
+    def counter_function(self, name, documentation, function):
+        return self.register(CallbackMetric(name, documentation, function, type='counter'))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+registry = MetricsRegistry()
+
+# Durations of instrumented functions, labelled by module and function name
+FUNCTION_SECONDS = registry.histogram('novel_reader_function_duration_seconds', 'Duration of instrumented functions.', ('module', 'function'))
+FUNCTION_ERRORS = registry.counter('novel_reader_function_errors_total', 'Exceptions raised by instrumented functions.', ('module', 'function'))
+
+# Durations of the steps inside a scrape that no single function covers (e.g. waiting for a pooled browser)
+STAGE_SECONDS = registry.histogram('novel_reader_stage_duration_seconds', 'Duration of scrape stages.', ('stage',))
+
+def timed(f):
+    """
+    Records the duration of every call of (f) in FUNCTION_SECONDS and the exceptions it raises in FUNCTION_ERRORS.
+    Generator functions are timed from the first to the last item, so a streamed query is measured as a whole.
+    """
+    labels = {'module': f.__module__, 'function': f.__qualname__}
+    if inspect.isgeneratorfunction(f):
+        @wraps(f)
+        def generator_wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                yield from f(*args, **kwargs)
+            except Exception:
+                FUNCTION_ERRORS.inc(**labels)
+                raise
+            finally:
+                FUNCTION_SECONDS.observe(time.perf_counter() - started, **labels)
+        return generator_wrapper
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return f(*args, **kwargs)
+        except Exception:
+            FUNCTION_ERRORS.inc(**labels)
+            raise
+        finally:
+            FUNCTION_SECONDS.observe(time.perf_counter() - started, **labels)
+    return wrapper
@@ -0,0 +1,107 @@
+import os
+import queue
+import logging
+import threading
+
+PRELOAD_WORKERS = int(os.getenv('PRELOAD_WORKERS', 2))
+
+class PreloadJob:
+    def __init__(self, key, scope, generation, target, args):
+        self.key = key                  # jobs with equal keys are coalesced
+        self.scope = scope              # jobs of a scope are superseded together
+        self.generation = generation
+        self.target = target
+        self.args = args
+        self.started = False
+
+class PreloadScheduler:
+    """
+    Fixed-size worker pool consuming a queue of preload jobs.
+
+    - submit() coalesces a job with a queued or running job of the same key instead of scraping twice.
+    - supersede() marks every queued job of a scope as stale; stale jobs are dropped instead of run.
+    Workers are started on the first submit so that importing the module doesn't spawn threads.
+    """
+    def __init__(self, workers=PRELOAD_WORKERS):
+        self.workers = workers
+        self.completed = 0
+        self.coalesced = 0
+        self.cancelled = 0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pending = {}              # key > latest job for that key
+        self._generations = {}          # scope > current generation
+        self._threads = []
+
+    def submit(self, key, scope, target, *args):
+        # Returns False when the job was merged into an existing one
+        with self._lock:
+            self._start_workers()
+            generation = self._generations.get(scope, 0)
+            job = self._pending.get(key)
+            if job is not None and not job.started:
+                job.generation, job.target, job.args = generation, target, args
+                self.coalesced += 1
+                return False
+            if job is not None and job.args == args and job.target is target:
+                self.coalesced += 1
+                return False
+            job = PreloadJob(key, scope, generation, target, args)
+            self._pending[key] = job
+        self._queue.put(job)
+        return True
+
+    def supersede(self, scope):
+        # Called when the reader has moved on, jobs submitted afterwards are unaffected
+        with self._lock:
+            self._generations[scope] = self._generations.get(scope, 0) + 1
+
+    def queue_depth(self):
+        # Number of live jobs waiting for a worker
+        with self._lock:
+            return sum(1 for job in self._pending.values() if not job.started and not self._is_stale(job))
+
+    def active_count(self):
+        with self._lock:
+            return sum(1 for job in self._pending.values() if job.started)
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue_depth(),
+            'active': self.active_count(),
+            'workers': self.workers,
+            'completed': self.completed,
+            'coalesced': self.coalesced,
+            'cancelled': self.cancelled
+        }
+
+    def _is_stale(self, job):
+        return job.generation < self._generations.get(job.scope, 0)
+
+    def _start_workers(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name=f'preload-worker-{len(self._threads)}', daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            with self._lock:
+                if self._pending.get(job.key) is not job or self._is_stale(job):
+                    if self._pending.get(job.key) is job:
+                        del self._pending[job.key]
+                    self.cancelled += 1
+                    continue
+                job.started = True
+            try:
+                job.target(*job.args)
+            except Exception as error:
+                logging.error(f'Error in preload job {job.key}: {error}')
+            finally:
+                with self._lock:
+                    if self._pending.get(job.key) is job:
+                        del self._pending[job.key]
+                    self.completed += 1
+
+preload_scheduler = PreloadScheduler()
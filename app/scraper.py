@@ -0,0 +1,169 @@
+import os
+import html
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from database import get_stored_chapter, store_chapter, get_indexed_chapter, index_chapter_urls, unindex_chapter
+from browser_pool import browser_pool
+from extractor import EXTRACTOR_BACKEND, get_http_chapter, get_http_paragraphs, get_table_of_contents
+from metrics import registry, timed, STAGE_SECONDS
+from hosts import host_limiter
+
+"""
+Chapter scraping
+Resolves chapter urls and extracts chapter content, with a plain HTTP fetch first and a pooled Selenium browser as fallback.
+Used by the web process for on-demand chapters and by the preload workers, in process or in app/worker.py.
+"""
+
+# Chapter urls are revalidated, and table of contents pages refetched, after this many seconds
+CHAPTER_INDEX_TTL = int(os.getenv('CHAPTER_INDEX_TTL', 604800))
+table_of_contents_checked = {}      # base_url > time.monotonic() of the last table of contents fetch
+table_of_contents_lock = threading.Lock()
+
+# Where fetched chapters came from: the shared store, a plain HTTP fetch, the browser, or nowhere (failed)
+CHAPTER_FETCHES = registry.counter('novel_reader_chapter_fetches_total', 'Chapters fetched for preloads and downloads by source.', ('source',))
+
+# Returns (url, content) of a chapter, resolving the chapter url and extracting its content, preferring a single plain HTTP fetch.
+# Falls back to a pooled browser when the fast path yields no paragraphs; the browser only resolves the redirect when the chapter index can't. 
+# Stale index entries, and indexed urls that no longer yield the chapter, are resolved again through the redirect of {base_url}/chapter-{n}. 
+# The index is refreshed with the url the chapter was found at, and its entry dropped when the chapter can't be found at all. 
+# Chapters another reader already loaded are taken from the shared chapter store without scraping, scraped chapters are stored for every reader. 
+# No browser is borrowed for a host that is cooling down, nor before one of the host's request slots is reserved (see hosts.py). 
+def fetch_chapter(base_url, chapter_number):
+    stored_chapter = get_stored_chapter(base_url, chapter_number)
+    if stored_chapter:
+        CHAPTER_FETCHES.inc(source='store')
+        return stored_chapter
+    indexed_url, fresh = resolve_chapter_url(base_url, chapter_number)
+    preload_url, preload_content, source = None, None, 'failed'
+    if indexed_url and fresh:
+        preload_url, preload_content, source = scrape_chapter(indexed_url, True)
+    if preload_content is None:
+        preload_url, preload_content, source = scrape_chapter(f"{base_url}/chapter-{chapter_number}", False)
+    CHAPTER_FETCHES.inc(source=source if preload_content is not None else 'failed')
+    if preload_content is None:
+        # A host that is cooling down says nothing about the url
+        if indexed_url and host_limiter.available(base_url):
+            unindex_chapter(base_url, chapter_number)
+        return preload_url, None
+    if preload_url != indexed_url or not fresh:
+        index_chapter_urls(base_url, {chapter_number: preload_url}, datetime.now().isoformat())
+    store_chapter(preload_url, base_url, chapter_number, preload_content)
+    return preload_url, preload_content
+
+# Returns (final url, content, source) of the chapter at given url, content is None when no paragraphs were found
+# (resolved) tells that the url is canonical already, the browser then loads it without resolving its redirect first. 
+def scrape_chapter(chapter_url, resolved):
+    url, content, source = None, None, 'http'
+    if EXTRACTOR_BACKEND != 'selenium':
+        url, content = get_http_chapter(chapter_url)
+    if content is None and EXTRACTOR_BACKEND != 'http' and host_limiter.available(chapter_url):
+        source = 'selenium'
+        try:
+            with host_limiter.reserve(chapter_url), browser_pool.driver() as driver:
+                url = chapter_url if resolved else get_url_redirect(chapter_url, driver)
+                content = get_reader_mode_content(url, driver)
+        except Exception as error:
+            logging.error(f'Error in scrape_chapter: {error}')
+    return url, content, source
+
+# Returns (url, fresh) for the canonical url of a chapter without loading the chapter itself, url is None when it is unknown
+# Looks up the chapter index, then fills the index in bulk from the novel's table of contents (at most once per CHAPTER_INDEX_TTL). 
+# Entries older than CHAPTER_INDEX_TTL are revalidated the same way; (fresh) is False when the table of contents didn't confirm them. 
+def resolve_chapter_url(base_url, chapter_number):
+    indexed_chapter = get_indexed_chapter(base_url, chapter_number)
+    if indexed_chapter and indexed_chapter[1] and datetime.now() - datetime.fromisoformat(indexed_chapter[1]) < timedelta(seconds=CHAPTER_INDEX_TTL):
+        return indexed_chapter[0], True
+    with table_of_contents_lock:
+        checked_at = table_of_contents_checked.get(base_url)
+        should_check = checked_at is None or time.monotonic() - checked_at > CHAPTER_INDEX_TTL
+        if should_check:
+            table_of_contents_checked[base_url] = time.monotonic()
+    if should_check:
+        chapter_urls = get_table_of_contents(base_url)
+        if chapter_urls:
+            index_chapter_urls(base_url, chapter_urls, datetime.now().isoformat())
+        if chapter_number in chapter_urls:
+            return chapter_urls[chapter_number], True
+    return (indexed_chapter[0], False) if indexed_chapter else (None, False)
+
+# Uses Selenium webdriver to return url redirect
+# Borrows a browser from the pool unless the caller already holds one. 
+@timed
+def get_url_redirect(url, driver=None):
+    if driver is None:
+        try:
+            with host_limiter.reserve(url), browser_pool.driver() as driver:
+                return get_url_redirect.__wrapped__(url, driver)
+        except Exception as error:
+            logging.error(f'Error in get_url_redirect: {error}')
+            return None
+    try:
+        with host_limiter.request(url), STAGE_SECONDS.time(stage='page_load'):
+            driver.get(url)
+        return driver.current_url
+    except Exception as error:
+        logging.error(f'Error in get_url_redirect: {error}')
+        return None
+
+# Extracts the reader view content of given url
+# Tries the plain HTTP extractor first and only renders the reader view with Selenium when it finds no paragraphs (see EXTRACTOR_BACKEND). 
+@timed
+def get_reader_mode_content(url, driver=None):
+    if url is None:
+        return None
+    if driver is None and EXTRACTOR_BACKEND != 'selenium':
+        _, content = get_http_chapter(url)
+        if content is not None or EXTRACTOR_BACKEND == 'http':
+            return content
+    if driver is None:
+        if not host_limiter.available(url):
+            return None
+        try:
+            with host_limiter.reserve(url), browser_pool.driver() as driver:
+                return get_reader_mode_content.__wrapped__(url, driver)
+        except Exception as error:
+            logging.error(f'Error in get_reader_mode_content: {error}')
+            return None
+    try:
+        return "".join(f'<p>{html.escape(paragraph)}</p>' for paragraph in read_reader_view(url, driver))
+    except Exception as error:
+        logging.error(f'Error in get_reader_mode_content: {error}')
+        return None
+
+# Yields the final url of given url after redirects, None when it couldn't be loaded, then the paragraphs of its reader view content
+# as they are extracted, for streaming cold chapters to the reader. 
+# The plain HTTP extractor yields the paragraphs of its single fetch; the browser yields each paragraph as soon as it is read. 
+# Browser errors are raised, possibly after some paragraphs, so that a partial chapter is never taken for a whole one. 
+@timed
+def iter_reader_mode_paragraphs(url):
+    if EXTRACTOR_BACKEND != 'selenium':
+        final_url, paragraphs = get_http_paragraphs(url)
+        if paragraphs or EXTRACTOR_BACKEND == 'http':
+            yield final_url
+            yield from paragraphs or ()
+            return
+    if not host_limiter.available(url):
+        yield None
+        return
+    with host_limiter.reserve(url), browser_pool.driver() as driver:
+        final_url = get_url_redirect(url, driver)
+        yield final_url
+        if final_url is not None:
+            yield from read_reader_view(final_url, driver)
+
+def read_reader_view(url, driver):
+    # Yields the text of each paragraph of the Firefox reader view of given url
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.common.by import By
+    # Only loading the page holds one of the host's request slots, waiting for the reader view doesn't involve the host
+    with host_limiter.request(url), STAGE_SECONDS.time(stage='page_load'):
+        driver.get(f'about:reader?url={url}')
+    with STAGE_SECONDS.time(stage='reader_wait'):
+        reader_content = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.CLASS_NAME, 'moz-reader-content')))
+        paragraphs = WebDriverWait(reader_content, 10).until(EC.presence_of_all_elements_located((By.TAG_NAME, 'p')))
+    for paragraph in paragraphs:
+        yield paragraph.text
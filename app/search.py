@@ -0,0 +1,41 @@
+import os
+import re
+import html
+
+from export import PARAGRAPH
+
+"""
+Full-text search over stored chapters
+The text of every stored chapter is indexed in the chapter_search FTS5 table (see create_db.py), keyed by the rowid of
+its chapters row, so a chapter stored again replaces its own entry. Queries are matched word by word: every word
+must appear in the chapter, a word ending with * matches as a prefix. Results are ranked by bm25.
+"""
+
+SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', 20))
+SEARCH_PAGE_MAX = 100
+SNIPPET_TOKENS = 16
+# Private-use characters delimiting matches in snippets, replaced by <mark> once the snippet is escaped
+MATCH_START = '\ue000'
+MATCH_END = '\ue001'
+
+WORD = re.compile(r'[^\s"]+')
+
+def chapter_text(content):
+    # Indexed text of reader view content: its paragraphs, one per line, with the escaping of the content undone
+    if content is None:
+        return ''
+    return '\n'.join(html.unescape(paragraph) for paragraph in PARAGRAPH.findall(content))
+
+def match_expression(query):
+    # FTS5 query of the words of (query), quoted so that operators and punctuation typed by users are searched as text
+    terms = []
+    for word in WORD.findall(query or ''):
+        prefix = word.endswith('*')
+        word = word.rstrip('*')
+        if word:
+            terms.append('"{}"{}'.format(word, '*' if prefix else ''))
+    return ' '.join(terms) or None
+
+def highlight(snippet):
+    # Escapes a snippet returned by the index and marks its matches
+    return html.escape(snippet or '').replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>')
@@ -0,0 +1,121 @@
+import os
+import time
+import logging
+import threading
+import urllib.error
+from datetime import datetime
+
+from database import claim_novel_checks, record_novel_checks, index_chapter_urls, NovelCheck, READ_AHEAD
+from extractor import fetch_if_modified, probe, extract_chapter_links, chapter_url_pattern
+from metrics import registry
+
+"""
+New-chapter checks
+Novels read with status ONGOING_STATUS are checked every NEW_CHAPTER_CHECK_INTERVAL seconds for chapters past the last known one.
+The novel's main page is fetched conditionally (ETag/Last-Modified): an unchanged page that lists the novel's chapters costs a
+304 and nothing else. Otherwise the chapter urls after the last known chapter are probed with HEAD requests until one is
+missing, so that a check costs one request more than the number of new chapters. Checks are claimed in the database, so
+every process running a checker shares the work without checking a novel twice.
+"""
+
+ONGOING_STATUS = 'In Progress'
+NEW_CHAPTER_CHECK_INTERVAL = float(os.getenv('NEW_CHAPTER_CHECK_INTERVAL', 3600))    # 0 disables the checks
+NEW_CHAPTER_CHECK_BATCH = int(os.getenv('NEW_CHAPTER_CHECK_BATCH', 50))            # novels claimed, checked and recorded at once
+NEW_CHAPTER_PROBE_MAX = int(os.getenv('NEW_CHAPTER_PROBE_MAX', 20))                # chapters probed per check
+NEW_CHAPTER_PREWARM = os.getenv('NEW_CHAPTER_PREWARM', '1') == '1'
+
+NOVEL_CHECKS = registry.counter('novel_reader_novel_checks_total', 'New-chapter checks of ongoing novels by result.', ('result',))
+NEW_CHAPTERS = registry.counter('novel_reader_new_chapters_total', 'Chapters found by new-chapter checks.')
+
+def check_novel(check):
+    """
+    Returns the NovelCheck of (check) updated with the chapters published since, indexing the urls of the new chapters.
+    The main page's chapter list is used when it has one, the chapters after the last listed one are still probed since
+    lists may be paginated.
+    """
+    base_url, last_chapter, etag, last_modified, listed = check
+    try:
+        page_url, html, etag, last_modified = fetch_if_modified(base_url, etag, last_modified)
+    except urllib.error.HTTPError as error:
+        # Novels without a main page are only probed
+        if not 400 <= error.code < 500:
+            logging.error(f'Error in check_novel: {error}')
+            NOVEL_CHECKS.inc(result='failed')
+            return check
+        page_url, html, etag, last_modified, listed = None, '', None, None, False
+    except Exception as error:
+        logging.error(f'Error in check_novel: {error}')
+        NOVEL_CHECKS.inc(result='failed')
+        return check
+    chapter_urls = {}
+    if html:
+        listed_urls = extract_chapter_links(html, page_url, base_url)
+        listed = bool(listed_urls)
+        chapter_urls.update((number, url) for number, url in listed_urls.items() if number > last_chapter)
+    elif html is None and listed:
+        NOVEL_CHECKS.inc(result='unchanged')
+        return check
+    pattern = chapter_url_pattern(base_url)
+    last_listed = max(chapter_urls, default=last_chapter)
+    try:
+        for chapter_number in range(last_listed + 1, last_listed + NEW_CHAPTER_PROBE_MAX + 1):
+            # Sites redirect missing chapters to the novel's page or to another chapter
+            final_url = probe(f'{base_url}/chapter-{chapter_number}')
+            match = pattern.match(final_url or '')
+            if match is None or int(match.group(1)) != chapter_number:
+                break
+            chapter_urls[chapter_number] = final_url
+    except Exception as error:
+        logging.error(f'Error in check_novel: {error}')
+        NOVEL_CHECKS.inc(result='failed')
+    else:
+        NOVEL_CHECKS.inc(result='updated' if chapter_urls else 'unchanged')
+    if chapter_urls:
+        index_chapter_urls(base_url, chapter_urls, datetime.now().isoformat())
+        NEW_CHAPTERS.inc(len(chapter_urls))
+    return NovelCheck(base_url, max(chapter_urls, default=last_chapter), etag, last_modified, listed)
+
+class NewChapterChecker:
+    """
+    Checks the ongoing novels that are due on one thread, started on first use.
+    With NEW_CHAPTER_PREWARM, (on_new_chapter)(user_id, base_url, chapter_number, priority) is called for every new chapter
+    within a reader's read-ahead window, nearest first, so that it is preloaded before the reader gets to it.
+    """
+    def __init__(self, on_new_chapter, interval=NEW_CHAPTER_CHECK_INTERVAL):
+        self.on_new_chapter = on_new_chapter
+        self.interval = interval
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._thread is not None or self.interval <= 0:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._check, name='new-chapter-checker', daemon=True)
+                self._thread.start()
+
+    def check_due_novels(self, batch_size=NEW_CHAPTER_CHECK_BATCH):
+        # Checks one batch of due novels and returns the number of novels checked
+        now = time.time()
+        checks = [check_novel(check) for check in claim_novel_checks(ONGOING_STATUS, now - self.interval, now, batch_size)]
+        if not checks:
+            return 0
+        for user_id, base_url, current_chapter, previous_total, total_chapters in record_novel_checks(ONGOING_STATUS, checks):
+            if not NEW_CHAPTER_PREWARM:
+                continue
+            first_chapter = max(previous_total or 0, current_chapter) + 1
+            last_chapter = min(total_chapters, current_chapter + READ_AHEAD)
+            for chapter_number in range(first_chapter, last_chapter + 1):
+                self.on_new_chapter(user_id, base_url, chapter_number, chapter_number - current_chapter)
+        return len(checks)
+
+    def _check(self, batch_size=NEW_CHAPTER_CHECK_BATCH):
+        while True:
+            checked = 0
+            try:
+                checked = self.check_due_novels(batch_size)
+            except Exception as error:
+                logging.error(f'Error in NewChapterChecker: {error}')
+            if checked < batch_size:
+                time.sleep(min(self.interval, 60))
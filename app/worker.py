@@ -0,0 +1,120 @@
+import os
+import time
+import signal
+import socket
+import logging
+import threading
+from datetime import datetime
+
+# Environment variables are loaded before the local modules below read their configuration, as in app.py
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if os.path.exists(os.path.join(project_root, '.env')):
+    from dotenv import load_dotenv
+    load_dotenv(os.path.join(project_root, '.env'))
+
+from database import get_connection, lease_job, finish_job, retry_job, purge_jobs, count_jobs, store_chapter, update_chapter_content, finish_prefetch_job
+from browser_pool import browser_pool
+from scraper import fetch_chapter, scrape_chapter
+from jobs import JOB_MAX_ATTEMPTS, JOB_LEASE, JOB_POLL_INTERVAL, JOB_RETENTION, prefetch_scope, retry_delay, enqueue_preload
+from updates import NewChapterChecker
+
+"""
+Scraping worker
+Consumes the durable job queue (see jobs.py) with WORKER_THREADS threads, each scraping one job at a time.
+Failed jobs are retried with exponential backoff up to JOB_MAX_ATTEMPTS times. Start as many worker processes as needed:
+    PRELOAD_QUEUE=database python app/worker.py
+Workers also check ongoing novels for new chapters (see updates.py) and queue preloads of the new chapters readers are close to.
+SIGINT/SIGTERM stop leasing new jobs and let the running ones finish.
+"""
+
+WORKER_THREADS = int(os.getenv('WORKER_THREADS', 2))
+PURGE_INTERVAL = 3600
+
+# Job handlers return the job's result, or None when the job failed and should be retried
+def run_preload(user_id, base_url, chapter_number):
+    chapter_url, _ = fetch_chapter(base_url, chapter_number)
+    if chapter_url is None:
+        return None
+    update_chapter_content(user_id, base_url, chapter_number, chapter_url, None)
+    return {'url': chapter_url}
+
+def run_prefetch(base_url, chapter_number):
+    chapter_url, content = fetch_chapter(base_url, chapter_number)
+    return None if content is None else {'url': chapter_url}
+
+def run_chapter(base_url, chapter_number, url):
+    # Stored at the chapter's final url after redirects, like preloaded chapters
+    chapter_url, content, _ = scrape_chapter(url, False)
+    if content is None:
+        return None
+    store_chapter(chapter_url, base_url, chapter_number, content)
+    return {'url': chapter_url}
+
+HANDLERS = {
+    'preload': run_preload,
+    'prefetch': run_prefetch,
+    'chapter': run_chapter
+}
+
+class Worker:
+    def __init__(self, threads=WORKER_THREADS):
+        self.threads = threads
+        self.name = f'{socket.gethostname()}:{os.getpid()}'
+        self.stopping = threading.Event()
+
+    def run(self):
+        workers = [threading.Thread(target=self._work, args=(f'{self.name}:{index}',), name=f'worker-{index}') for index in range(self.threads)]
+        for thread in workers:
+            thread.start()
+        NewChapterChecker(enqueue_preload).start()
+        logging.info(f'Worker {self.name} started with {self.threads} threads')
+        while not self.stopping.is_set():
+            purge_jobs(time.time() - JOB_RETENTION)
+            self.stopping.wait(PURGE_INTERVAL)
+        for thread in workers:
+            thread.join()
+        browser_pool.shutdown()
+        logging.info(f'Worker {self.name} stopped')
+
+    def stop(self, *args):
+        self.stopping.set()
+
+    def _work(self, owner):
+        while not self.stopping.is_set():
+            job = lease_job(owner, JOB_LEASE, time.time())
+            if job is None:
+                self.stopping.wait(JOB_POLL_INTERVAL)
+                continue
+            self._run(job, owner)
+
+    def _run(self, job, owner):
+        result, error_message = None, None
+        try:
+            result = HANDLERS[job.kind](*job.args)
+        except Exception as error:
+            error_message = str(error)
+            logging.error(f'Error in {job.kind} job {job.id}: {error}')
+        if result is not None:
+            finish_job(job.id, owner, 'done', result, None, time.time())
+        elif job.attempts < JOB_MAX_ATTEMPTS:
+            retry_job(job.id, owner, time.time() + retry_delay(job.attempts), error_message or 'no content')
+            return
+        else:
+            finish_job(job.id, owner, 'failed', None, error_message or 'no content', time.time())
+        if job.kind == 'prefetch':
+            self._finish_prefetch(job.args[0])
+
+    def _finish_prefetch(self, base_url):
+        # The worker finishing the last chapter of a whole-novel download records its outcome
+        counts = count_jobs(prefetch_scope(base_url))
+        if counts.get('queued', 0) + counts.get('leased', 0) == 0:
+            finish_prefetch_job(base_url, counts.get('failed', 0), datetime.now().isoformat())
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    # Refuses to start on a database that scripts/create_db.py hasn't migrated
+    get_connection()
+    worker = Worker()
+    signal.signal(signal.SIGINT, worker.stop)
+    signal.signal(signal.SIGTERM, worker.stop)
+    worker.run()
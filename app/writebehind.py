@@ -0,0 +1,91 @@
+import atexit
+import logging
+import threading
+import time
+
+"""
+Write-behind buffering
+Updates are coalesced per key in memory and written by a flush function in one batch: every (interval) seconds on a
+background thread started by the first update, as soon as (max_entries) keys are pending, and when the process exits.
+A crash loses at most the updates of the last (interval) seconds. An (interval) of 0 writes every update through.
+Pending values stay readable until the flush that writes them has committed, so that readers merging them with what
+they read from the database never see an update disappear. Buffers are per process.
+"""
+
+class WriteBehindBuffer:
+    """
+    (flush_function)({key: value}) writes a batch and returns False when it failed, the batch is then kept for the next flush.
+    (merge)(pending, update) combines an update with the value pending for its key, (pending) is None for a new key.
+    """
+    def __init__(self, flush_function, merge, interval, max_entries):
+        self.flush_function = flush_function
+        self.merge = merge
+        self.interval = interval
+        self.max_entries = max_entries
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()     # one flush at a time, so that batches are written in order
+        self._thread = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, key, update):
+        with self._lock:
+            self._pending[key] = self.merge(self._pending.get(key), update)
+            full = len(self._pending) >= self.max_entries
+        if self.interval <= 0 or full:
+            self.flush()
+        else:
+            self.start()
+
+    def get(self, key):
+        with self._lock:
+            return self._pending.get(key)
+
+    def items(self):
+        # Snapshot of the pending (key, value) pairs
+        with self._lock:
+            return list(self._pending.items())
+
+    def discard(self, key):
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def flush(self, keys=None):
+        # Writes the pending values, or only those of (keys), and returns False when the flush failed
+        with self._flush_lock:
+            with self._lock:
+                if keys is None:
+                    batch = dict(self._pending)
+                else:
+                    batch = {key: self._pending[key] for key in keys if key in self._pending}
+            if not batch:
+                return True
+            try:
+                flushed = self.flush_function(batch)
+            except Exception as error:
+                logging.error(f'Error in WriteBehindBuffer.flush: {error}')
+                flushed = False
+            if not flushed:
+                return False
+            with self._lock:
+                # Keys updated again while the batch was written stay pending with their newer value
+                for key, value in batch.items():
+                    if self._pending.get(key) is value:
+                        del self._pending[key]
+            return True
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._flush_periodically, name='write-behind', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
@@ -0,0 +1,421 @@
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import platform
+import threading
+import statistics
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+"""
+Offline benchmark of the reading flow
+Serves synthetic novels from a local HTTP server and replaces Firefox with a stub webdriver, then drives
+/api/extract, /api/navigate_chapters and the preload scheduler through Flask's test client against a fresh database.
+Nothing leaves the machine, so results of two runs with the same arguments are comparable.
+
+Usage: python scripts/benchmark.py [--backend selenium|http|auto] [--users 8] [--output benchmark-results.json]
+"""
+
+scripts_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(scripts_dir)
+
+WORDS = 'the of and a to in he was that it his her with as had for she on at by but not from they were be which you'.split()
+
+def chapter_html(novel, chapter_number, paragraphs):
+    # Chapter page with site boilerplate around the prose, as the extractors see on real sites
+    text = ''.join(
+        '<p>{}, {}.</p>'.format(' '.join(WORDS[(novel + chapter_number + index + offset) % len(WORDS)] for offset in range(30)), index)
+        for index in range(paragraphs))
+    return (
+        f'<html><head><title>Novel {novel} - Chapter {chapter_number}</title></head><body>'
+        '<nav><p>Home</p><p>Browse</p></nav>'
+        f'<div class="chapter-content">{text}</div>'
+        '<div class="comments"><p>First!</p></div>'
+        '</body></html>')
+
+def table_of_contents_html(novel, chapters):
+    links = ''.join(f'<li><a href="/novel-{novel}/chapter-{number}-part-{number}">Chapter {number}</a></li>' for number in range(1, chapters + 1))
+    return f'<html><body><h1>Novel {novel}</h1><ul>{links}</ul></body></html>'
+
+class NovelSite(ThreadingHTTPServer):
+    """
+    Synthetic novel site. '/novel-{k}' lists the chapters, '/novel-{k}/chapter-{n}' redirects to the canonical
+    '/novel-{k}/chapter-{n}-part-{n}' page. Every response is delayed by (latency) seconds to stand in for the network.
+    """
+    daemon_threads = True
+
+    def __init__(self, chapters, paragraphs, latency, table_of_contents):
+        super().__init__(('127.0.0.1', 0), NovelSiteHandler)
+        self.chapters = chapters
+        self.paragraphs = paragraphs
+        self.latency = latency
+        self.table_of_contents = table_of_contents
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+class NovelSiteHandler(BaseHTTPRequestHandler):
+    PAGE = re.compile(r'^/novel-(\d+)(?:/chapter-(\d+)(-part-\d+)?)?/?$')
+
+    def do_GET(self):
+        site = self.server
+        with site.lock:
+            site.requests += 1
+        time.sleep(site.latency)
+        match = self.PAGE.match(self.path)
+        if not match:
+            return self.send_error(404)
+        novel, chapter_number, canonical = int(match.group(1)), match.group(2), match.group(3)
+        if chapter_number is None:
+            if not site.table_of_contents:
+                return self.send_error(404)
+            return self.send_page(table_of_contents_html(novel, site.chapters))
+        chapter_number = int(chapter_number)
+        if not 1 <= chapter_number <= site.chapters:
+            return self.send_error(404)
+        if canonical is None:
+            self.send_response(302)
+            self.send_header('Location', f'/novel-{novel}/chapter-{chapter_number}-part-{chapter_number}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_page(chapter_html(novel, chapter_number, site.paragraphs))
+
+    def send_page(self, html):
+        body = html.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeElement:
+    # Stand-in for a located WebElement, children are what find_elements returns
+    # Reading its text takes (read_latency) seconds like a webdriver round trip
+    read_latency = 0.0
+
+    def __init__(self, text='', children=()):
+        self._text = text
+        self.children = list(children)
+
+    @property
+    def text(self):
+        time.sleep(self.read_latency)
+        return self._text
+
+    def find_elements(self, by, value):
+        return self.children
+
+class FakeDriver:
+    """
+    Stub webdriver covering what the app uses: get(), current_url, find_element() of the reader view and quit().
+    Pages are loaded over HTTP and the reader view is rendered with the plain extractor, so only the
+    browser itself is missing. Launching takes (launch_time) seconds like starting a headless Firefox.
+    """
+    launch_time = 0.0
+
+    def __init__(self):
+        time.sleep(self.launch_time)
+        self.current_url = 'about:blank'
+        self.reader = None
+
+    def get(self, url):
+        from extractor import fetch, extract_paragraphs
+        self.reader = None
+        if url.startswith('about:reader?url='):
+            _, html = fetch(url[len('about:reader?url='):])
+            self.reader = FakeElement(children=[FakeElement(text) for text in extract_paragraphs(html)])
+            self.current_url = url
+        else:
+            self.current_url, _ = fetch(url)
+
+    def find_element(self, by, value):
+        from selenium.common.exceptions import NoSuchElementException
+        if value == 'moz-reader-content' and self.reader is not None:
+            return self.reader
+        raise NoSuchElementException(value)
+
+    def quit(self):
+        pass
+
+def summarize(samples):
+    # Latency summary in milliseconds
+    if not samples:
+        return {'count': 0}
+    samples = sorted(samples)
+    cut_points = statistics.quantiles(samples, n=100, method='inclusive') if len(samples) > 1 else samples * 99
+    return {
+        'count': len(samples),
+        'mean_ms': round(statistics.fmean(samples) * 1000, 3),
+        'p50_ms': round(cut_points[49] * 1000, 3),
+        'p95_ms': round(cut_points[94] * 1000, 3),
+        'p99_ms': round(cut_points[98] * 1000, 3),
+        'max_ms': round(samples[-1] * 1000, 3),
+    }
+
+class Benchmark:
+    def __init__(self, args, site):
+        import app as application
+        from metrics import FUNCTION_SECONDS
+        from scheduler import preload_scheduler
+        self.args = args
+        self.site = site
+        self.app = application.app
+        self.function_seconds = FUNCTION_SECONDS
+        self.scheduler = preload_scheduler
+        self.next_novel = 0
+
+    def client(self, user_id):
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['user'] = user_id
+        return client
+
+    def add_novel(self, client):
+        # Adds a novel nobody has read yet, returns its first chapter url
+        novel = self.next_novel
+        self.next_novel += 1
+        link = f'{self.site.url}/novel-{novel}/chapter-1'
+        client.post('/api/add_novel', data={'title': f'Novel {novel}', 'current_chapter': 1, 'total_chapters': self.args.chapters, 'status': 'Ongoing', 'link': link})
+        return link
+
+    def extract(self, client, url):
+        # Returns the url the chapter was stored at, which the reading page switches to
+        response = client.post('/api/extract', json={'url': url})
+        if response.status_code != 200:
+            raise RuntimeError(f'/api/extract returned {response.status_code} for {url}')
+        return response.get_json()['url']
+
+    def extract_streamed(self, client, url):
+        # Returns (seconds to the first paragraph, seconds to the whole chapter, url the chapter was stored at) of a streamed extraction
+        started = time.perf_counter()
+        response = client.post('/api/extract', json={'url': url}, headers={'Accept': 'application/x-ndjson'}, buffered=False)
+        if response.status_code != 200 or response.mimetype != 'application/x-ndjson':
+            raise RuntimeError(f'/api/extract returned {response.status_code} {response.mimetype} for {url}')
+        first_paragraph = None
+        lines = b''
+        try:
+            for chunk in response.response:
+                if first_paragraph is None and b'"paragraph"' in chunk:
+                    first_paragraph = time.perf_counter() - started
+                lines += chunk
+        finally:
+            response.close()
+        last_line = json.loads(lines.splitlines()[-1])
+        if not last_line.get('done'):
+            raise RuntimeError(f'/api/extract streamed {last_line} for {url}')
+        return first_paragraph, time.perf_counter() - started, last_line['url']
+
+    def next_url(self, client, url, timeout=30):
+        # Clicks 'next' until the chapter is preloaded, as the reader does when told the chapter is pending
+        deadline = time.monotonic() + timeout
+        while True:
+            result = client.post('/api/navigate_chapters', json={'url': url, 'id': 'nextButton'}).get_json()
+            if result['navigate_url'] or not result['pending']:
+                return result['navigate_url']
+            if time.monotonic() > deadline:
+                raise RuntimeError(f'Chapter after {url} was not preloaded within {timeout}s')
+            time.sleep(0.005)
+
+    def wait_for_preloads(self, timeout=60):
+        deadline = time.monotonic() + timeout
+        while self.scheduler.queue_depth() or self.scheduler.active_count():
+            if time.monotonic() > deadline:
+                raise RuntimeError('Preloads did not settle')
+            time.sleep(0.005)
+
+    def database_timings(self):
+        # {function: (total seconds, calls)} of the database functions so far
+        timings = {}
+        for name, labels, value in self.function_seconds.samples():
+            if labels.get('module') != 'database':
+                continue
+            if name.endswith('_sum'):
+                timings.setdefault(labels['function'], [0.0, 0])[0] = value
+            elif name.endswith('_count'):
+                timings.setdefault(labels['function'], [0.0, 0])[1] = value
+        return timings
+
+    def database_contention(self, before):
+        # Mean duration of each database function over the calls made since (before)
+        contention = {}
+        for function, (total, calls) in self.database_timings().items():
+            previous_total, previous_calls = before.get(function, (0.0, 0))
+            if calls > previous_calls:
+                contention[function] = {'calls': calls - previous_calls, 'mean_ms': round((total - previous_total) / (calls - previous_calls) * 1000, 3)}
+        return contention
+
+    def first_open(self):
+        # Opening the first chapter of a novel nobody has read, nothing is preloaded or stored
+        client = self.client('benchmark-first-open')
+        samples = []
+        for _ in range(self.args.novels):
+            url = self.add_novel(client)
+            started = time.perf_counter()
+            self.extract(client, url)
+            samples.append(time.perf_counter() - started)
+            self.wait_for_preloads()
+        return {'latency': summarize(samples)}
+
+    def first_open_streamed(self):
+        # First chapter opens streamed paragraph by paragraph, as the reading page requests them
+        client = self.client('benchmark-first-open-streamed')
+        first_paragraphs, samples = [], []
+        for _ in range(self.args.novels):
+            url = self.add_novel(client)
+            first_paragraph, elapsed, _ = self.extract_streamed(client, url)
+            if first_paragraph is not None:
+                first_paragraphs.append(first_paragraph)
+            samples.append(elapsed)
+            self.wait_for_preloads()
+        return {'latency': summarize(samples), 'first_paragraph': summarize(first_paragraphs)}
+
+    def warm_turns(self):
+        # Page turns with the read-ahead window settled between turns
+        client = self.client('benchmark-warm')
+        url = self.add_novel(client)
+        url = self.extract(client, url)
+        samples = []
+        for _ in range(min(self.args.turns, self.args.chapters - 1)):
+            self.wait_for_preloads()
+            started = time.perf_counter()
+            url = self.extract(client, self.next_url(client, url))
+            samples.append(time.perf_counter() - started)
+        return {'latency': summarize(samples)}
+
+    def rapid_clicks(self):
+        # Page turns as fast as the reader can click, outrunning the read-ahead window
+        client = self.client('benchmark-rapid')
+        url = self.add_novel(client)
+        url = self.extract(client, url)
+        self.wait_for_preloads()
+        samples = []
+        for _ in range(min(self.args.turns, self.args.chapters - 1)):
+            started = time.perf_counter()
+            url = self.extract(client, self.next_url(client, url))
+            samples.append(time.perf_counter() - started)
+        self.wait_for_preloads()
+        return {'latency': summarize(samples)}
+
+    def concurrent_users(self):
+        # (users) readers clicking through different novels at once
+        clients = [self.client(f'benchmark-user-{user}') for user in range(self.args.users)]
+        urls = [self.add_novel(client) for client in clients]
+        samples = []
+        errors = []
+        lock = threading.Lock()
+        def read(client, url):
+            try:
+                turns = []
+                started = time.perf_counter()
+                url = self.extract(client, url)
+                turns.append(time.perf_counter() - started)
+                for _ in range(min(self.args.turns, self.args.chapters - 1)):
+                    started = time.perf_counter()
+                    url = self.extract(client, self.next_url(client, url))
+                    turns.append(time.perf_counter() - started)
+                with lock:
+                    samples.extend(turns)
+            except Exception as error:
+                with lock:
+                    errors.append(str(error))
+        database_before = self.database_timings()
+        completed_before = self.scheduler.completed
+        started = time.perf_counter()
+        readers = [threading.Thread(target=read, args=(client, url)) for client, url in zip(clients, urls)]
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+        self.wait_for_preloads()
+        elapsed = time.perf_counter() - started
+        preloads = self.scheduler.completed - completed_before
+        return {
+            'latency': summarize(samples),
+            'elapsed_s': round(elapsed, 3),
+            'preloads': preloads,
+            'preload_throughput_per_s': round(preloads / elapsed, 3),
+            'database': self.database_contention(database_before),
+            'errors': errors,
+        }
+
+    def run(self):
+        scenarios = {}
+        for name in ('first_open', 'first_open_streamed', 'warm_turns', 'rapid_clicks', 'concurrent_users'):
+            started = time.perf_counter()
+            scenarios[name] = getattr(self, name)()
+            logging.info(f'{name} finished in {time.perf_counter() - started:.2f}s: {scenarios[name]["latency"]}')
+        return scenarios
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Offline benchmark of chapter extraction, navigation and preloading.')
+    parser.add_argument('--backend', choices=('selenium', 'http', 'auto'), default='selenium', help='EXTRACTOR_BACKEND of the run, selenium uses the stub webdriver')
+    parser.add_argument('--users', type=int, default=8, help='concurrent simulated readers')
+    parser.add_argument('--novels', type=int, default=10, help='novels opened by the first-chapter scenario')
+    parser.add_argument('--chapters', type=int, default=50, help='chapters per novel')
+    parser.add_argument('--turns', type=int, default=20, help='page turns per reader')
+    parser.add_argument('--paragraphs', type=int, default=60, help='paragraphs per chapter')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds added to every response of the novel site')
+    parser.add_argument('--launch-time', type=float, default=0.5, help='seconds the stub webdriver takes to launch')
+    parser.add_argument('--read-latency', type=float, default=0.002, help='seconds the stub webdriver takes to read the text of an element')
+    parser.add_argument('--host-rate', type=float, default=1000, help='HOST_RATE and HOST_BURST of the local site, the default keeps politeness limits out of the measurements')
+    parser.add_argument('--host-concurrency', type=int, default=64, help='HOST_CONCURRENCY of the local site')
+    parser.add_argument('--no-table-of-contents', action='store_true', help='serve novels without a table of contents, so chapter urls are resolved by redirect')
+    parser.add_argument('--output', default='benchmark-results.json', help='file the JSON results are written to')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    output = os.path.abspath(args.output)
+    # The app reads its configuration at import time
+    os.environ['EXTRACTOR_BACKEND'] = args.backend
+    os.environ['HOST_RATE'] = os.environ['HOST_BURST'] = str(args.host_rate)
+    os.environ['HOST_CONCURRENCY'] = str(args.host_concurrency)
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ.setdefault('PYTHON_KEYRING_BACKEND', 'keyring.backends.null.Keyring')
+    sys.path.insert(0, os.path.join(project_root, 'app'))
+    sys.path.insert(0, scripts_dir)
+    from create_db import migrate
+    working_dir = tempfile.mkdtemp(prefix='novel-reader-benchmark-')
+    site = NovelSite(args.chapters, args.paragraphs, args.latency, not args.no_table_of_contents)
+    threading.Thread(target=site.serve_forever, daemon=True).start()
+    previous_dir = os.getcwd()
+    try:
+        os.chdir(working_dir)
+        migrate()
+        FakeDriver.launch_time = args.launch_time
+        FakeElement.read_latency = args.read_latency
+        from browser_pool import browser_pool
+        browser_pool.factory = FakeDriver
+        benchmark = Benchmark(args, site)
+        started = time.perf_counter()
+        scenarios = benchmark.run()
+        results = {
+            'config': {**vars(args), 'output': output},
+            'environment': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+            'scenarios': scenarios,
+            'site_requests': site.requests,
+            'elapsed_s': round(time.perf_counter() - started, 3),
+        }
+    finally:
+        os.chdir(previous_dir)
+        site.shutdown()
+        shutil.rmtree(working_dir, ignore_errors=True)
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=2)
+    logging.info(f'Results written to {output}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import os
+import sys
+import argparse
+import subprocess
+
+"""
+Import-time budget check
+Imports the app in a fresh interpreter with python -X importtime and fails when importing it takes longer than
+the budget, or when a module that must only be imported on first use (Selenium, authlib, keyring) is loaded at start-up.
+Run it after changing imports: python scripts/check_import_time.py [--budget-ms 400]
+"""
+
+scripts_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(scripts_dir)
+
+# Top-level packages a worker must not import before they are needed
+LAZY_MODULES = ('selenium', 'authlib', 'keyring')
+
+def measure_imports(module='app'):
+    # Returns (cumulative microseconds, [(cumulative microseconds, module name, depth)] of the imports made by (module))
+    env = dict(os.environ, SECRET_KEY=os.getenv('SECRET_KEY', 'import-time-check'))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=os.path.join(project_root, 'app'), env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'Importing {module} failed:\n{result.stderr}')
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((int(cumulative), name.strip(), depth))
+    # Nested imports are reported before their parent, the module's imports are the deeper lines right before it
+    index = max(index for index, (_, name, depth) in enumerate(imports) if name == module and depth == 0)
+    first = index
+    while first > 0 and imports[first - 1][2] > 0:
+        first -= 1
+    return imports[index][0], imports[first:index]
+
+def main():
+    parser = argparse.ArgumentParser(description='Fail when importing the app exceeds its time budget or loads lazily imported modules.')
+    parser.add_argument('--budget-ms', type=float, default=float(os.getenv('IMPORT_BUDGET_MS', 400)), help='maximum cumulative import time of the app module')
+    parser.add_argument('--runs', type=int, default=3, help='imports measured, the fastest one is compared to the budget')
+    parser.add_argument('--top', type=int, default=10, help='slowest direct imports of the app listed')
+    args = parser.parse_args()
+
+    total, imports = min((measure_imports() for _ in range(args.runs)), key=lambda run: run[0])
+    total_ms = total / 1000
+    print(f'import app: {total_ms:.1f} ms (budget {args.budget_ms:.0f} ms, fastest of {args.runs})')
+    direct_imports = sorted(((cumulative, name) for cumulative, name, depth in imports if depth == 1), reverse=True)
+    for cumulative, name in direct_imports[:args.top]:
+        print(f'  {cumulative / 1000:8.1f} ms  {name}')
+
+    failures = []
+    eager = sorted({name.split('.')[0] for _, name, _ in imports if name.split('.')[0] in LAZY_MODULES})
+    if eager:
+        failures.append(f'imported at start-up: {", ".join(eager)}')
+    if total_ms > args.budget_ms:
+        failures.append(f'import time {total_ms:.1f} ms exceeds the {args.budget_ms:.0f} ms budget')
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,63 +1,246 @@
+import os
+import sys
+import html
 import sqlite3
 import logging
 
-def create_library_table():
-    conn = None
-    try:
-        conn = sqlite3.connect('library.db')
-        conn.execute('BEGIN TRANSACTION')
-        c = conn.cursor()
+# Migrations that transform stored content use the app's codecs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+from compression import encode_content, decode_content
+from search import chapter_text
+from export import PARAGRAPH
+
+DATABASE_NAME = 'library.db'
+
+"""
+Versioned schema migrations.
+The schema version is kept in SQLite's user_version pragma. Running this script applies every migration
+newer than the database's version, each in its own transaction, so existing databases are upgraded in place.
+New schema changes are appended to MIGRATIONS and never edit an already released migration, and database.SCHEMA_VERSION
+is raised to the new version: the app refuses databases older than that.
+"""
+
+def create_library_table(c):
+    c.execute(
+        '''CREATE TABLE IF NOT EXISTS library (
+            user_id TEXT NOT NULL,
+            title TEXT NOT NULL,
+            current_chapter INTEGER,
+            total_chapters INTEGER,
+            status TEXT,
+            base_url TEXT,
+            current_url TEXT,
+            current_content TEXT,
+            previous_chapter INTEGER DEFAULT 0,
+            previous_url TEXT,
+            previous_content TEXT,
+            next_chapter INTEGER DEFAULT 0,
+            next_url TEXT,
+            next_content TEXT,
+            time TEXT
+        )''')
+
+def create_display_preferences_table(c):
+    c.execute(
+        '''CREATE TABLE IF NOT EXISTS display_preferences (
+            user_id TEXT NOT NULL PRIMARY KEY,
+            mode TEXT,
+            font TEXT,
+            font_size INTEGER
+        )''')
+
+def create_chapters_table(c):
+    # Chapter content shared by every user, keyed by canonical (redirect-resolved) chapter url
+    c.execute(
+        '''CREATE TABLE IF NOT EXISTS chapters (
+            url TEXT NOT NULL PRIMARY KEY,
+            base_url TEXT NOT NULL,
+            chapter_number INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            fetched_at TEXT
+        )''')
+    c.execute('CREATE INDEX IF NOT EXISTS chapters_novel ON chapters (base_url, chapter_number)')
+
+def create_initial_schema(c):
+    # Tables as they existed before migrations, databases created by earlier versions of this script already have them
+    create_library_table(c)
+    create_display_preferences_table(c)
+    create_chapters_table(c)
+
+def add_library_key(c):
+    # Keeps the most recently read row of duplicated novels, then makes (user_id, base_url) unique
+    c.execute(
+        '''DELETE FROM library WHERE rowid NOT IN (
+            SELECT rowid FROM (
+                SELECT rowid, ROW_NUMBER() OVER (PARTITION BY user_id, base_url ORDER BY time DESC, rowid DESC) AS rank FROM library
+            ) WHERE rank = 1
+        )''')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS library_user_novel ON library (user_id, base_url)')
+
+def add_library_time_index(c):
+    # Serves the library listing ordered by most recently read
+    c.execute('CREATE INDEX IF NOT EXISTS library_user_time ON library (user_id, time)')
+
+def create_reading_window_table(c):
+    # Chapters preloaded around each reader's position, replaces the fixed previous/current/next slots of the library table
+    c.execute(
+        '''CREATE TABLE IF NOT EXISTS reading_window (
+            user_id TEXT NOT NULL,
+            base_url TEXT NOT NULL,
+            chapter_number INTEGER NOT NULL,
+            url TEXT NOT NULL,
+            PRIMARY KEY (user_id, base_url, chapter_number)
+        )''')
+    for slot in ('previous', 'current', 'next'):
+        # Slot content moves to the shared chapter store and slot urls seed the window
         c.execute(
-            '''CREATE TABLE IF NOT EXISTS library (
-                user_id TEXT NOT NULL,
-                title TEXT NOT NULL,
-                current_chapter INTEGER,
-                total_chapters INTEGER,
-                status TEXT,
-                base_url TEXT,
-                current_url TEXT,
-                current_content TEXT,
-                previous_chapter INTEGER DEFAULT 0,
-                previous_url TEXT,
-                previous_content TEXT,
-                next_chapter INTEGER DEFAULT 0,
-                next_url TEXT,
-                next_content TEXT,
-                time TEXT
-            )''')
-        conn.commit()
-    except sqlite3.Error as error:
-        if conn:
-            conn.rollback()
-        logging.error(f'Error creating library table in create_db.py: {error}')
-        raise
-    finally:
-        if conn:
-            conn.close()
+            '''INSERT OR IGNORE INTO chapters (url, base_url, chapter_number, content, fetched_at)
+                SELECT {0}_url, base_url, {0}_chapter, {0}_content, time FROM library
+                WHERE {0}_url IS NOT NULL AND {0}_chapter > 0 AND {0}_content IS NOT NULL'''.format(slot))
+        c.execute(
+            '''INSERT OR IGNORE INTO reading_window (user_id, base_url, chapter_number, url)
+                SELECT user_id, base_url, {0}_chapter, {0}_url FROM library
+                WHERE {0}_url IS NOT NULL AND {0}_chapter > 0'''.format(slot))
+    c.execute('UPDATE library SET previous_content=NULL, current_content=NULL, next_content=NULL')
+
+def create_prefetch_jobs_table(c):
+    # Whole-novel downloads, progress is counted from the chapters table so an interrupted job resumes where it stopped
+    c.execute(
+        '''CREATE TABLE IF NOT EXISTS prefetch_jobs (
+            base_url TEXT NOT NULL PRIMARY KEY,
+            status TEXT NOT NULL,
+            total_chapters INTEGER NOT NULL,
+            failed_chapters INTEGER NOT NULL DEFAULT 0,
+            started_at TEXT,
+            updated_at TEXT
+        )''')
+
+def add_library_page_index(c):
+    # Serves cursor paging over (time, base_url), replaces the (user_id, time) index
+    c.execute('DROP INDEX IF EXISTS library_user_time')
+    c.execute('CREATE INDEX IF NOT EXISTS library_user_time_novel ON library (user_id, time, base_url)')
+
+def create_chapter_index_table(c):
+    # Canonical url of each chapter number, seeded from the chapters already stored
+    c.execute(
+        '''CREATE TABLE IF NOT EXISTS chapter_index (
+            base_url TEXT NOT NULL,
+            chapter_number INTEGER NOT NULL,
+            url TEXT NOT NULL,
+            resolved_at TEXT NOT NULL,
+            PRIMARY KEY (base_url, chapter_number)
+        )''')
+    c.execute(
+        '''INSERT OR IGNORE INTO chapter_index (base_url, chapter_number, url, resolved_at)
+            SELECT base_url, chapter_number, url, COALESCE(fetched_at, '') FROM chapters''')
+
+def create_jobs_table(c):
+    # Durable queue of scraping jobs consumed by worker processes
+    c.execute(
+        '''CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_key TEXT NOT NULL UNIQUE,
+            kind TEXT NOT NULL,
+            scope TEXT,
+            args TEXT NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            available_at REAL NOT NULL,
+            lease_owner TEXT,
+            lease_expires_at REAL,
+            result TEXT,
+            error TEXT,
+            enqueued_at REAL NOT NULL,
+            finished_at REAL,
+            finished_seq INTEGER
+        )''')
+    c.execute('CREATE INDEX IF NOT EXISTS jobs_runnable ON jobs (status, priority, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS jobs_scope ON jobs (scope, status)')
+    c.execute('CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished_seq)')
+
+def create_chapter_search_table(c):
+    # Full-text index of chapter text, rowids follow the chapters table, seeded from the chapters already stored
+    c.execute(
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS chapter_search USING fts5(
+            text,
+            base_url UNINDEXED,
+            chapter_number UNINDEXED,
+            url UNINDEXED,
+            tokenize='unicode61 remove_diacritics 2'
+        )''')
+    chapters = c.connection.execute('SELECT rowid, base_url, chapter_number, url, content FROM chapters')
+    for rowid, base_url, chapter_number, url, content in chapters:
+        c.execute('INSERT INTO chapter_search (rowid, text, base_url, chapter_number, url) VALUES (?, ?, ?, ?, ?)',
+            (rowid, chapter_text(decode_content(content)), base_url, chapter_number, url))
 
-def create_display_preferences_table():
+def create_novel_checks_table(c):
+    # New-chapter checks of ongoing novels: last chapter found and the validators of the novel's main page
+    c.execute(
+        '''CREATE TABLE IF NOT EXISTS novel_checks (
+            base_url TEXT NOT NULL PRIMARY KEY,
+            last_chapter INTEGER NOT NULL DEFAULT 0,
+            etag TEXT,
+            last_modified TEXT,
+            listed INTEGER NOT NULL DEFAULT 0,
+            checked_at REAL NOT NULL DEFAULT 0
+        )''')
+    c.execute('CREATE INDEX IF NOT EXISTS library_status_novel ON library (status, base_url)')
+
+def escape_chapter_paragraphs(c):
+    # Paragraph text is stored escaped, the reading page inserts content as HTML; chapters stored before held raw text
+    rowids = [rowid for rowid, in c.connection.execute('SELECT rowid FROM chapters')]
+    for rowid in rowids:
+        content = decode_content(c.execute('SELECT content FROM chapters WHERE rowid=?', (rowid,)).fetchone()[0])
+        if content is None:
+            continue
+        escaped = ''.join(f'<p>{html.escape(paragraph)}</p>' for paragraph in PARAGRAPH.findall(content))
+        if escaped != content:
+            c.execute('UPDATE chapters SET content=? WHERE rowid=?', (encode_content(escaped), rowid))
+
+# (version, migration) in application order
+MIGRATIONS = [
+    (1, create_initial_schema),
+    (2, add_library_key),
+    (3, add_library_time_index),
+    (4, create_reading_window_table),
+    (5, create_prefetch_jobs_table),
+    (6, add_library_page_index),
+    (7, create_chapter_index_table),
+    (8, create_jobs_table),
+    (9, create_chapter_search_table),
+    (10, create_novel_checks_table),
+    (11, escape_chapter_paragraphs),
+]
+
+def get_schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate(database_name=DATABASE_NAME):
+    # Applies pending migrations and returns the resulting schema version
     conn = None
     try:
-        conn = sqlite3.connect('library.db')
-        conn.execute('BEGIN TRANSACTION')
-        c = conn.cursor()
-        c.execute(
-            '''CREATE TABLE IF NOT EXISTS display_preferences (
-                user_id TEXT NOT NULL PRIMARY KEY,
-                mode TEXT,
-                font TEXT,
-                font_size INTEGER 
-            )''')
-        conn.commit()
-    except sqlite3.Error as error:
-        if conn:
-            conn.rollback()
-        logging.error(f'Error creating user preferences table in create_db.py: {error}')
-        raise
+        conn = sqlite3.connect(database_name, isolation_level=None)
+        version = get_schema_version(conn)
+        for migration_version, migration in MIGRATIONS:
+            if migration_version <= version:
+                continue
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                migration(conn.cursor())
+                conn.execute('PRAGMA user_version={}'.format(migration_version))
+                conn.execute('COMMIT')
+            except sqlite3.Error as error:
+                conn.execute('ROLLBACK')
+                logging.error(f'Error applying migration {migration_version} ({migration.__name__}) in create_db.py: {error}')
+                raise
+            version = migration_version
+            logging.info(f'Applied migration {migration_version} ({migration.__name__})')
+        return version
     finally:
         if conn:
             conn.close()
 
 if __name__ == '__main__':
-    create_library_table()
-    create_display_preferences_table()
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO)
+    migrate()
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The app's modules import each other by name from app/, as when it runs from there; migrations are imported from scripts/
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(project_root, 'app'))
+sys.path.insert(0, os.path.join(project_root, 'scripts'))
@@ -0,0 +1,28 @@
+import sqlite3
+
+import pytest
+
+import database
+import create_db
+
+@pytest.fixture
+def database_name(tmp_path, monkeypatch):
+    name = str(tmp_path / 'library.db')
+    monkeypatch.setattr(database, 'DATABASE_NAME', name)
+    database.close_connection()
+    yield name
+    database.close_connection()
+
+def test_schema_version_follows_the_last_migration():
+    assert database.SCHEMA_VERSION == create_db.MIGRATIONS[-1][0]
+
+def test_outdated_schema_is_refused(database_name):
+    conn = sqlite3.connect(database_name)
+    conn.execute('PRAGMA user_version=10')
+    conn.close()
+    with pytest.raises(sqlite3.DatabaseError, match='create_db.py'):
+        database.get_connection()
+
+def test_migrated_schema_is_accepted(database_name):
+    create_db.migrate(database_name)
+    assert database.get_stored_chapter('http://novel.test/n', 1) is None
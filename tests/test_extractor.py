@@ -0,0 +1,112 @@
+import os
+from contextlib import contextmanager
+
+import extractor
+import scraper
+from extractor import extract_paragraphs, get_http_chapter
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding='utf-8') as fixture:
+        return fixture.read()
+
+def serve_fixture(monkeypatch, name):
+    # Answers every plain HTTP fetch with a fixture, as if the url redirected to its canonical form
+    monkeypatch.setattr(extractor, 'fetch', lambda url: (url + '-canonical', read_fixture(name)))
+
+class FakeBrowserPool:
+    def __init__(self):
+        self.checkouts = 0
+
+    @contextmanager
+    def driver(self):
+        self.checkouts += 1
+        yield object()
+
+def test_boilerplate_is_skipped():
+    paragraphs = extract_paragraphs(read_fixture('boilerplate.html'))
+    assert paragraphs[0] == 'The caravan left at dawn, before the mist had lifted from the valley.'
+    assert len(paragraphs) == 3
+    text = ' '.join(paragraphs)
+    for boilerplate in ('Novel Site', 'Home, Latest', 'translator', 'Copyright', 'Injected', 'color'):
+        assert boilerplate not in text
+
+def test_line_breaks_inside_paragraphs():
+    paragraphs = extract_paragraphs(read_fixture('boilerplate.html'))
+    assert paragraphs[1] == 'Mira counted the wagons twice, then a third time to be sure.'
+
+def test_entities_are_decoded():
+    paragraphs = extract_paragraphs(read_fixture('boilerplate.html'))
+    assert paragraphs[2] == '“Café at the border, Tom & Jerry’s,” she said — <quietly>.'
+
+def test_best_container_is_picked():
+    paragraphs = extract_paragraphs(read_fixture('containers.html'))
+    assert len(paragraphs) == 3
+    assert paragraphs[0].startswith('Rain fell on the city')
+    assert paragraphs[2] == 'On the fourth day the sun came back, and with it, the inspectors.'
+
+def test_no_paragraphs():
+    assert extract_paragraphs(read_fixture('no_paragraphs.html')) == []
+    assert extract_paragraphs('') == []
+
+def test_get_http_chapter(monkeypatch):
+    serve_fixture(monkeypatch, 'containers.html')
+    final_url, content = get_http_chapter('http://novel.test/n/chapter-1')
+    assert final_url == 'http://novel.test/n/chapter-1-canonical'
+    assert content.startswith('<p>Rain fell on the city') and content.count('<p>') == 3
+
+def test_get_http_chapter_escapes_paragraphs(monkeypatch):
+    # Text that looks like markup stays text when the reading page inserts the content as HTML
+    serve_fixture(monkeypatch, 'boilerplate.html')
+    _, content = get_http_chapter('http://novel.test/n/chapter-12')
+    assert '&lt;quietly&gt;' in content and 'Tom &amp; Jerry' in content
+    assert '<quietly>' not in content
+
+def test_reader_view_paragraphs_are_escaped(monkeypatch):
+    monkeypatch.setattr(scraper, 'read_reader_view', lambda url, driver: iter(['<img src=x onerror=alert(1)>']))
+    assert scraper.get_reader_mode_content('http://novel.test/n/chapter-1', object()) == '<p>&lt;img src=x onerror=alert(1)&gt;</p>'
+
+def test_get_http_chapter_without_paragraphs(monkeypatch):
+    serve_fixture(monkeypatch, 'no_paragraphs.html')
+    assert get_http_chapter('http://novel.test/n/chapter-1') == ('http://novel.test/n/chapter-1-canonical', None)
+
+def test_get_http_chapter_fetch_failure(monkeypatch):
+    def fail(url):
+        raise OSError('connection refused')
+    monkeypatch.setattr(extractor, 'fetch', fail)
+    assert get_http_chapter('http://novel.test/n/chapter-1') == (None, None)
+
+def test_reader_mode_content_falls_back_to_selenium(monkeypatch):
+    serve_fixture(monkeypatch, 'no_paragraphs.html')
+    browser_pool = FakeBrowserPool()
+    monkeypatch.setattr(scraper, 'EXTRACTOR_BACKEND', 'auto')
+    monkeypatch.setattr(scraper, 'browser_pool', browser_pool)
+    monkeypatch.setattr(scraper, 'read_reader_view', lambda url, driver: iter(['From the reader view.']))
+    assert scraper.get_reader_mode_content('http://novel.test/n/chapter-1') == '<p>From the reader view.</p>'
+    assert browser_pool.checkouts == 1
+
+def test_fetch_chapter_falls_back_to_selenium(monkeypatch):
+    serve_fixture(monkeypatch, 'no_paragraphs.html')
+    browser_pool = FakeBrowserPool()
+    stored = []
+    monkeypatch.setattr(scraper, 'EXTRACTOR_BACKEND', 'auto')
+    monkeypatch.setattr(scraper, 'browser_pool', browser_pool)
+    monkeypatch.setattr(scraper, 'get_stored_chapter', lambda base_url, chapter_number: None)
+    monkeypatch.setattr(scraper, 'resolve_chapter_url', lambda base_url, chapter_number: (None, False))
+    monkeypatch.setattr(scraper, 'index_chapter_urls', lambda base_url, chapter_urls, time: None)
+    monkeypatch.setattr(scraper, 'store_chapter', lambda *args: stored.append(args))
+    monkeypatch.setattr(scraper, 'get_url_redirect', lambda url, driver=None: url + '-redirected')
+    monkeypatch.setattr(scraper, 'read_reader_view', lambda url, driver: iter(['From the reader view.']))
+    url, content = scraper.fetch_chapter('http://novel.test/n', 2)
+    assert (url, content) == ('http://novel.test/n/chapter-2-redirected', '<p>From the reader view.</p>')
+    assert browser_pool.checkouts == 1
+    assert stored == [(url, 'http://novel.test/n', 2, content)]
+
+def test_http_backend_has_no_fallback(monkeypatch):
+    serve_fixture(monkeypatch, 'no_paragraphs.html')
+    browser_pool = FakeBrowserPool()
+    monkeypatch.setattr(scraper, 'EXTRACTOR_BACKEND', 'http')
+    monkeypatch.setattr(scraper, 'browser_pool', browser_pool)
+    assert scraper.get_reader_mode_content('http://novel.test/n/chapter-1') is None
+    assert browser_pool.checkouts == 0
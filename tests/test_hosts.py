@@ -0,0 +1,100 @@
+import socket
+import urllib.error
+
+import pytest
+
+import hosts
+from hosts import HostLimiter, HostUnavailable, is_failure, HOST_FAILURE_THRESHOLD
+
+URL = 'http://novel.test/n/chapter-1'
+
+class TimeoutException(Exception):
+    # Stands in for selenium.common.exceptions.TimeoutException, matched by name
+    pass
+
+def http_error(code):
+    return urllib.error.HTTPError(URL, code, 'error', {}, None)
+
+@pytest.mark.parametrize('error', [http_error(429), http_error(500), http_error(503), urllib.error.URLError('refused'), socket.timeout('timed out'), ConnectionResetError(), TimeoutException(), Exception('Reached error page: about:neterror?e=dnsNotFound')])
+def test_failures(error):
+    assert is_failure(error)
+
+@pytest.mark.parametrize('error', [http_error(404), http_error(304), http_error(501), HostUnavailable('cooling down'), ValueError('no reader content'), GeneratorExit()])
+def test_not_failures(error):
+    assert not is_failure(error)
+
+def test_misses_do_not_open_the_circuit():
+    limiter = HostLimiter()
+    for _ in range(HOST_FAILURE_THRESHOLD + 1):
+        with pytest.raises(ValueError):
+            with limiter.request(URL):
+                raise ValueError('no reader content')
+    assert limiter.available(URL)
+    assert limiter.stats()['novel.test']['failed'] == 0
+
+def test_failures_open_the_circuit(monkeypatch):
+    limiter = HostLimiter()
+    for failure in range(1, HOST_FAILURE_THRESHOLD + 1):
+        # No cooldown between the failures, the last one opens the circuit for a while
+        monkeypatch.setattr(hosts, 'HOST_BACKOFF', 60 if failure == HOST_FAILURE_THRESHOLD else 0)
+        with pytest.raises(TimeoutException):
+            with limiter.request(URL):
+                raise TimeoutException()
+    assert not limiter.available(URL)
+
+def test_abandoned_generator_releases_its_slot():
+    limiter = HostLimiter()
+    def stream():
+        with limiter.request(URL):
+            yield 'first paragraph'
+            yield 'second paragraph'
+    paragraphs = stream()
+    next(paragraphs)
+    assert limiter.stats()['novel.test']['in_flight'] == 1
+    paragraphs.close()
+    assert limiter.stats()['novel.test']['in_flight'] == 0
+    assert limiter.stats()['novel.test']['failed'] == 0
+
+def test_cooldown_fails_fast(monkeypatch):
+    monkeypatch.setattr(hosts, 'HOST_BACKOFF_MAX', 60)
+    limiter = HostLimiter()
+    throttled = urllib.error.HTTPError(URL, 429, 'Too Many Requests', {'Retry-After': '3600'}, None)
+    with pytest.raises(urllib.error.HTTPError):
+        with limiter.request(URL):
+            raise throttled
+    # The circuit is still closed, but requests aren't held back for the cooldown
+    assert limiter.stats()['novel.test']['circuit'] == 'closed'
+    assert not limiter.available(URL)
+    with pytest.raises(HostUnavailable):
+        with limiter.request(URL):
+            pass
+    # Retry-After is capped at HOST_BACKOFF_MAX
+    assert limiter.stats()['novel.test']['cooldown'] <= 60
+
+def test_reserved_slot_is_used_by_the_next_request():
+    limiter = HostLimiter()
+    with limiter.reserve(URL):
+        assert limiter.stats()['novel.test']['in_flight'] == 1
+        with limiter.request(URL):
+            assert limiter.stats()['novel.test']['in_flight'] == 1
+        assert limiter.stats()['novel.test']['in_flight'] == 0
+        with limiter.request(URL):
+            assert limiter.stats()['novel.test']['in_flight'] == 1
+    assert limiter.stats()['novel.test']['requests'] == 2
+
+def test_unused_reservation_is_given_back():
+    limiter = HostLimiter()
+    with pytest.raises(TimeoutError):
+        with limiter.reserve(URL):
+            raise TimeoutError('No browser available')
+    assert limiter.stats()['novel.test']['in_flight'] == 0
+    assert limiter.stats()['novel.test']['requests'] == 0
+
+def test_reservation_during_cooldown():
+    limiter = HostLimiter()
+    with pytest.raises(TimeoutException):
+        with limiter.request(URL):
+            raise TimeoutException()
+    with pytest.raises(HostUnavailable):
+        with limiter.reserve(URL):
+            pass
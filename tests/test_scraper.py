@@ -0,0 +1,114 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import pytest
+
+import scraper
+from hosts import HostLimiter
+
+BASE_URL = 'http://novel.test/n'
+
+class FakeIndex:
+    # In-memory chapter index and chapter store in place of the database functions used by the scraper
+    def __init__(self, monkeypatch, entries):
+        self.entries = dict(entries)        # chapter number > (url, resolved_at)
+        self.stored = []
+        monkeypatch.setattr(scraper, 'get_stored_chapter', lambda base_url, chapter_number: None)
+        monkeypatch.setattr(scraper, 'get_indexed_chapter', lambda base_url, chapter_number: self.entries.get(chapter_number))
+        monkeypatch.setattr(scraper, 'index_chapter_urls', self.index)
+        monkeypatch.setattr(scraper, 'unindex_chapter', lambda base_url, chapter_number: self.entries.pop(chapter_number, None))
+        monkeypatch.setattr(scraper, 'store_chapter', lambda *args: self.stored.append(args))
+        monkeypatch.setattr(scraper, 'get_table_of_contents', lambda base_url: {})
+        monkeypatch.setattr(scraper, 'EXTRACTOR_BACKEND', 'http')
+        monkeypatch.setattr(scraper, 'table_of_contents_checked', {})
+
+    def index(self, base_url, chapter_urls, time):
+        for chapter_number, url in chapter_urls.items():
+            self.entries[chapter_number] = (url, time)
+
+def serve(monkeypatch, pages):
+    # (pages) maps requested urls to (final url, content), other urls yield nothing
+    requested = []
+    def get_http_chapter(url):
+        requested.append(url)
+        return pages.get(url, (None, None))
+    monkeypatch.setattr(scraper, 'get_http_chapter', get_http_chapter)
+    return requested
+
+def resolved_at(age):
+    return (datetime.now() - timedelta(seconds=age)).isoformat()
+
+def test_fresh_entry_is_used(monkeypatch):
+    index = FakeIndex(monkeypatch, {3: (BASE_URL + '/chapter-3-the-storm', resolved_at(10))})
+    requested = serve(monkeypatch, {BASE_URL + '/chapter-3-the-storm': (BASE_URL + '/chapter-3-the-storm', '<p>Storm.</p>')})
+    assert scraper.fetch_chapter(BASE_URL, 3) == (BASE_URL + '/chapter-3-the-storm', '<p>Storm.</p>')
+    assert requested == [BASE_URL + '/chapter-3-the-storm']
+    assert index.stored == [(BASE_URL + '/chapter-3-the-storm', BASE_URL, 3, '<p>Storm.</p>')]
+
+def test_stale_entry_is_resolved_again(monkeypatch):
+    index = FakeIndex(monkeypatch, {3: (BASE_URL + '/chapter-3-old-slug', resolved_at(scraper.CHAPTER_INDEX_TTL + 10))})
+    requested = serve(monkeypatch, {BASE_URL + '/chapter-3': (BASE_URL + '/chapter-3-new-slug', '<p>Storm.</p>')})
+    assert scraper.fetch_chapter(BASE_URL, 3) == (BASE_URL + '/chapter-3-new-slug', '<p>Storm.</p>')
+    assert requested == [BASE_URL + '/chapter-3']
+    assert index.entries[3][0] == BASE_URL + '/chapter-3-new-slug'
+
+def test_stale_entry_is_refreshed(monkeypatch):
+    stale = resolved_at(scraper.CHAPTER_INDEX_TTL + 10)
+    index = FakeIndex(monkeypatch, {3: (BASE_URL + '/chapter-3', stale)})
+    serve(monkeypatch, {BASE_URL + '/chapter-3': (BASE_URL + '/chapter-3', '<p>Storm.</p>')})
+    scraper.fetch_chapter(BASE_URL, 3)
+    assert index.entries[3][1] > stale
+
+def test_broken_entry_falls_back_to_redirect(monkeypatch):
+    index = FakeIndex(monkeypatch, {3: (BASE_URL + '/chapter-3-gone', resolved_at(10))})
+    requested = serve(monkeypatch, {BASE_URL + '/chapter-3': (BASE_URL + '/chapter-3-moved', '<p>Storm.</p>')})
+    assert scraper.fetch_chapter(BASE_URL, 3) == (BASE_URL + '/chapter-3-moved', '<p>Storm.</p>')
+    assert requested == [BASE_URL + '/chapter-3-gone', BASE_URL + '/chapter-3']
+    assert index.entries[3][0] == BASE_URL + '/chapter-3-moved'
+
+@pytest.mark.parametrize('age', [10, scraper.CHAPTER_INDEX_TTL + 10])
+def test_entry_is_dropped_when_nothing_resolves(monkeypatch, age):
+    index = FakeIndex(monkeypatch, {3: (BASE_URL + '/chapter-3-gone', resolved_at(age))})
+    serve(monkeypatch, {BASE_URL + '/chapter-3': (BASE_URL + '/chapter-3', None)})
+    assert scraper.fetch_chapter(BASE_URL, 3) == (BASE_URL + '/chapter-3', None)
+    assert 3 not in index.entries
+    assert index.stored == []
+
+def test_failed_fetch_is_not_indexed(monkeypatch):
+    # Error pages redirected to, e.g. the novel's main page, yield no content and must not become the chapter's url
+    index = FakeIndex(monkeypatch, {})
+    serve(monkeypatch, {BASE_URL + '/chapter-9': (BASE_URL, None)})
+    assert scraper.fetch_chapter(BASE_URL, 9) == (BASE_URL, None)
+    assert index.entries == {}
+
+def test_browser_is_borrowed_after_the_host_slot(monkeypatch):
+    limiter = HostLimiter()
+    checkouts = []
+    class BrowserPool:
+        @contextmanager
+        def driver(self):
+            checkouts.append(limiter.stats()['novel.test']['in_flight'])
+            yield object()
+    def read_reader_view(url, driver):
+        with limiter.request(url):
+            yield 'From the reader view.'
+    monkeypatch.setattr(scraper, 'host_limiter', limiter)
+    monkeypatch.setattr(scraper, 'browser_pool', BrowserPool())
+    monkeypatch.setattr(scraper, 'EXTRACTOR_BACKEND', 'selenium')
+    monkeypatch.setattr(scraper, 'read_reader_view', read_reader_view)
+    assert scraper.scrape_chapter(BASE_URL + '/chapter-3', True) == (BASE_URL + '/chapter-3', '<p>From the reader view.</p>', 'selenium')
+    assert checkouts == [1]
+    assert limiter.stats()['novel.test'] == dict(limiter.stats()['novel.test'], in_flight=0, requests=1)
+
+def test_no_browser_for_a_cooling_host(monkeypatch):
+    limiter = HostLimiter()
+    with pytest.raises(OSError):
+        with limiter.request(BASE_URL):
+            raise OSError('connection reset')
+    class BrowserPool:
+        def driver(self):
+            raise AssertionError('browser borrowed for a cooling host')
+    monkeypatch.setattr(scraper, 'host_limiter', limiter)
+    monkeypatch.setattr(scraper, 'browser_pool', BrowserPool())
+    monkeypatch.setattr(scraper, 'EXTRACTOR_BACKEND', 'selenium')
+    assert scraper.scrape_chapter(BASE_URL + '/chapter-3', False)[:2] == (None, None)
@@ -0,0 +1,100 @@
+import threading
+
+from writebehind import WriteBehindBuffer
+
+def add(pending, update):
+    return (pending or 0) + update
+
+class Store:
+    # Flush function recording each written batch, failing while (failing) is set
+    def __init__(self):
+        self.batches = []
+        self.failing = False
+
+    def flush(self, batch):
+        if self.failing:
+            return False
+        self.batches.append(batch)
+        return True
+
+def test_updates_are_coalesced_per_key():
+    store = Store()
+    buffer = WriteBehindBuffer(store.flush, add, interval=60, max_entries=100)
+    buffer.put('a', 1)
+    buffer.put('a', 2)
+    buffer.put('b', 5)
+    assert buffer.get('a') == 3 and len(buffer) == 2
+    assert buffer.flush()
+    assert store.batches == [{'a': 3, 'b': 5}]
+    assert len(buffer) == 0
+
+def test_flush_of_some_keys():
+    store = Store()
+    buffer = WriteBehindBuffer(store.flush, add, interval=60, max_entries=100)
+    buffer.put('a', 1)
+    buffer.put('b', 2)
+    assert buffer.flush(['a', 'c'])
+    assert store.batches == [{'a': 1}]
+    assert buffer.items() == [('b', 2)]
+
+def test_full_buffer_flushes():
+    store = Store()
+    buffer = WriteBehindBuffer(store.flush, add, interval=60, max_entries=2)
+    buffer.put('a', 1)
+    assert store.batches == []
+    buffer.put('b', 2)
+    assert store.batches == [{'a': 1, 'b': 2}]
+
+def test_zero_interval_writes_through():
+    store = Store()
+    buffer = WriteBehindBuffer(store.flush, add, interval=0, max_entries=100)
+    buffer.put('a', 1)
+    assert store.batches == [{'a': 1}] and len(buffer) == 0
+
+def test_failed_flush_keeps_its_batch():
+    store = Store()
+    buffer = WriteBehindBuffer(store.flush, add, interval=60, max_entries=100)
+    buffer.put('a', 1)
+    store.failing = True
+    assert not buffer.flush()
+    assert buffer.get('a') == 1
+    buffer.put('a', 2)
+    store.failing = False
+    assert buffer.flush()
+    assert store.batches == [{'a': 3}]
+
+def test_raising_flush_keeps_its_batch():
+    def flush(batch):
+        raise OSError('disk I/O error')
+    buffer = WriteBehindBuffer(flush, add, interval=60, max_entries=100)
+    buffer.put('a', 1)
+    assert not buffer.flush()
+    assert buffer.get('a') == 1
+    # Nothing left for the flush at exit
+    buffer.discard('a')
+
+def test_keys_updated_during_a_flush_stay_pending():
+    written = threading.Event()
+    resume = threading.Event()
+    batches = []
+    def flush(batch):
+        batches.append(batch)
+        if len(batches) == 1:
+            written.set()
+            resume.wait(5)
+        return True
+    buffer = WriteBehindBuffer(flush, add, interval=60, max_entries=100)
+    buffer.put('a', 1)
+    buffer.put('b', 1)
+    flushing = threading.Thread(target=buffer.flush)
+    flushing.start()
+    assert written.wait(5)
+    # Read while the batch is written: the pending value is still visible, then updated
+    assert buffer.get('a') == 1
+    buffer.put('a', 2)
+    resume.set()
+    flushing.join(5)
+    # The flushed value of 'b' is dropped, 'a' keeps its newer value for the next flush
+    assert buffer.items() == [('a', 3)]
+    assert buffer.flush()
+    assert batches == [{'a': 1, 'b': 1}, {'a': 3}]